@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Load and latency benchmark of the crude app against a local mongod.
+# The app always uses the database "crude" of MONGODB_URI, so point it at a throwaway mongod:
+#
+#   python benchmark/run.py --mongodb-uri mongodb://127.0.0.1:27017 --scale 10k --output baseline.json
+#   python benchmark/run.py --scale 10k --baseline baseline.json
+#
+# Entries are only generated when the collections are empty or --reseed is given.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CRUDE_DIR = os.path.abspath(os.path.join(BENCHMARK_DIR, '../crude'))
+DATA_MODELS_FILE = os.path.abspath(os.path.join(BENCHMARK_DIR, '../data_models/knowledge.json'))
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+INSERT_BATCH_SIZE = 10000
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet', 'kilo', 'lima',
+         'mike', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango', 'uniform', 'victor', 'whiskey',
+         'xray', 'yankee', 'zulu', 'mongo', 'flask', 'index', 'cursor', 'shard', 'replica', 'bucket', 'vector']
+SCENARIOS = ['browse_first_page', 'browse_deep_page', 'browse_deep_keyset', 'read_with_relations', 'save',
+             'search_full_text', 'search_prefix', 'search_regex']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the crude app with synthetic data based on data_models/knowledge.json')
+    parser.add_argument('--mongodb-uri', default=os.getenv('MONGODB_URI', 'mongodb://127.0.0.1:27017'))
+    parser.add_argument('--scale', default='10k', help='number of informations entries: 10k, 100k, 1m or a number')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='requests per scenario before measuring')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reseed', action='store_true', help='drop and regenerate the benchmark collections')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='compare with the results in this file and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 latency increase against the baseline')
+    return parser.parse_args()
+
+
+def create_app(mongodb_uri):
+    os.environ['MONGODB_URI'] = mongodb_uri
+    os.environ.setdefault('SEARCH_CACHE_SIZE', '0')
+    os.environ.setdefault('SLOW_COMMAND_MS', '1000000')
+    os.environ.setdefault('SLOW_REQUEST_MS', '1000000')
+    sys.path.insert(0, CRUDE_DIR)
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['TESTING'] = True
+    return app
+
+
+def new_client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['wallet'] = 'benchmark'
+    return client
+
+
+def load_models(client, storage):
+    # through the model save path, then the declared indexes, which the save path builds in the background
+    from blueprints.helper.index_builds import build_indexes
+    with open(DATA_MODELS_FILE) as models_file:
+        models = json.load(models_file)
+    response = client.post('/models/save', data={'model': json.dumps(models)})
+    if response.status_code >= 400:
+        raise RuntimeError('Saving the models failed with status %s' % response.status_code)
+    for model in models:
+        build_indexes(storage, model['name'])
+    return models
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for i in range(length))
+
+
+def seed_entries(storage, scale, rng, reseed):
+    from bson.objectid import ObjectId
+    sizes = {'topics': max(scale // 100, 1), 'threads': max(scale // 10, 1), 'informations': scale}
+    if not reseed and all(storage.get_estimated_count(model_name) >= size for model_name, size in sizes.items()):
+        return sizes
+    for model_name in sizes:
+        storage.get_collection(model_name).delete_many({})
+    topic_ids = [ObjectId() for i in range(sizes['topics'])]
+    thread_ids = [ObjectId() for i in range(sizes['threads'])]
+    insert(storage, 'topics', ({'_id': topic_id, 'name': 'topic %d %s' % (i, sentence(rng, 2)), 'status': rng.choice(['open', 'closed'])} for i, topic_id in enumerate(topic_ids)))
+    insert(storage, 'threads', ({'_id': thread_id, 'name': 'thread %d %s' % (i, sentence(rng, 3)), 'next_step': sentence(rng, 5), 'related_topic': ['topics/%s' % rng.choice(topic_ids)]} for i, thread_id in enumerate(thread_ids)))
+    # most informations belong to one thread, some to a few
+    insert(storage, 'informations', ({
+        'title': 'information %d %s' % (i, sentence(rng, 4)),
+        'descriptions': sentence(rng, rng.randint(10, 80)),
+        'source': 'https://example.com/%s/%d' % (rng.choice(WORDS), i),
+        'related_thread': ['threads/%s' % thread_id for thread_id in rng.sample(thread_ids, min(rng.choice([1, 1, 1, 2, 3]), len(thread_ids)))]
+    } for i in range(sizes['informations'])))
+    return sizes
+
+
+def insert(storage, model_name, entries):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            storage.insert_many(model_name, batch)
+            batch = []
+    if len(batch) > 0:
+        storage.insert_many(model_name, batch)
+
+
+def sample_ids(storage, model_name, count):
+    collection = storage.get_collection(model_name)
+    return [str(entry['_id']) for entry in collection.aggregate([{'$sample': {'size': count}}, {'$project': {'_id': 1}}])] or [None]
+
+
+def deep_keyset_token(storage, model_name, position):
+    from persistence.keyset import keyset_sort, encode_token
+    sort_list = keyset_sort({})
+    entry = next(iter(storage.get_collection(model_name).find({}, {'_id': 1}).sort(sort_list).skip(position).limit(1)), None)
+    return encode_token(sort_list, entry) if entry else None
+
+
+def build_scenarios(storage, sizes, rng):
+    # each scenario is a function (client, rng) -> response
+    information_ids = sample_ids(storage, 'informations', 100)
+    thread_ids = sample_ids(storage, 'threads', 100)
+    deep_page = max(sizes['informations'] // 10 // 2, 1)
+    deep_token = deep_keyset_token(storage, 'informations', sizes['informations'] // 2)
+
+    def save(client, rng):
+        entry_id = rng.choice(information_ids)
+        data = {'title': 'information %s %s' % (entry_id, sentence(rng, 4)), 'descriptions': sentence(rng, 30), 'source': 'https://example.com/%s' % entry_id, 'related_thread': ['threads/%s' % rng.choice(thread_ids)]}
+        return client.post('/entries/save/informations/%s' % entry_id, json=data)
+
+    return {
+        'browse_first_page': lambda client, rng: client.get('/entries/browse/informations'),
+        'browse_deep_page': lambda client, rng: client.get('/entries/browse/informations/%d?paging=page' % deep_page),
+        'browse_deep_keyset': lambda client, rng: client.get('/entries/browse/informations', query_string={'after': deep_token, 'paging': 'keyset'}),
+        'read_with_relations': lambda client, rng: client.get('/entries/read/threads/%s' % rng.choice(thread_ids)),
+        'save': save,
+        'search_full_text': lambda client, rng: client.get('/entries/search/full-text/informations', query_string={'q': rng.choice(WORDS)}),
+        'search_prefix': lambda client, rng: client.get('/entries/search/prefix/informations', query_string={'q': 'information %d' % rng.randint(1, 99)}),
+        'search_regex': lambda client, rng: client.get('/entries/search/regex/informations', query_string={'q': rng.choice(WORDS)[:4]}),
+    }
+
+
+def run_scenario(app, scenario, requests, warmup, concurrency, seed):
+    def worker(worker_number):
+        client = new_client(app)
+        rng = random.Random(seed + worker_number)
+        for i in range(warmup // concurrency):
+            scenario(client, rng)
+        timings = []
+        for i in range(requests // concurrency):
+            started = time.perf_counter()
+            response = scenario(client, rng)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            commands = response.headers.get('X-Mongo-Commands')
+            timings.append((elapsed, int(commands) if commands is not None else None, response.status_code < 400))
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        timings = [timing for worker_timings in executor.map(worker, range(concurrency)) for timing in worker_timings]
+    wall_time = time.perf_counter() - started
+    latencies = sorted(timing[0] * 1000 for timing in timings)
+    commands = [timing[1] for timing in timings if timing[1] is not None]
+    return {
+        'requests': len(timings),
+        'errors': len([timing for timing in timings if not timing[2]]),
+        'throughput_rps': round(len(timings) / wall_time, 2),
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': round(latencies[-1], 3),
+        'mongo_commands_per_request': round(statistics.mean(commands), 2) if commands else None,
+    }
+
+
+def percentile(sorted_values, percent):
+    # nearest rank
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return round(sorted_values[min(rank, len(sorted_values) - 1)], 3)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.1f ms -> %.1f ms' % (name, before['p95_ms'], result['p95_ms']))
+        if before.get('mongo_commands_per_request') is not None and result['mongo_commands_per_request'] is not None and result['mongo_commands_per_request'] > before['mongo_commands_per_request']:
+            regressions.append('%s: MongoDB commands per request %s -> %s' % (name, before['mongo_commands_per_request'], result['mongo_commands_per_request']))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    scale = SCALES.get(args.scale.lower()) or int(args.scale)
+    rng = random.Random(args.seed)
+    app = create_app(args.mongodb_uri)
+    from blueprints.helper.common import new_storage
+    with app.app_context():
+        storage = new_storage()
+        load_models(new_client(app), storage)
+        print('Seeding %d entries...' % scale, file=sys.stderr)
+        sizes = seed_entries(storage, scale, rng, args.reseed)
+        scenarios = build_scenarios(storage, sizes, rng)
+    results = {
+        'scale': scale,
+        'sizes': sizes,
+        'requests_per_scenario': args.requests,
+        'concurrency': args.concurrency,
+        'seed': args.seed,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'scenarios': {}
+    }
+    for name in args.scenarios.split(','):
+        print('Running %s...' % name, file=sys.stderr)
+        results['scenarios'][name] = run_scenario(app, scenarios[name], args.requests, args.warmup, args.concurrency, args.seed)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
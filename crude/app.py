@@ -4,16 +4,25 @@ from flask import Flask, render_template
 from flask_cors import CORS
 from flask_wtf.csrf import CSRFProtect
 
-from blueprints.helper.common import render_tag, render_entry, db
+from blueprints.helper.common import render_tag, render_entry, db, field_types, new_storage
+from blueprints.helper.index_builds import resume_index_builds
+from blueprints.helper.migrations import resume_migrations
 from blueprints.entry import entry_blueprint
 from blueprints.model import model_blueprint
 from blueprints.auth import auth_blueprint
+from blueprints.status import status_blueprint
 
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
 
 app = Flask(__name__)
 app.register_blueprint(model_blueprint)
 app.register_blueprint(entry_blueprint)
 app.register_blueprint(auth_blueprint)
+app.register_blueprint(status_blueprint)
+app.jinja_env.globals['field_types'] = field_types
 app.secret_key = 'something unique and secret'
 CORS(app)
 CSRFProtect(app)
@@ -23,6 +32,11 @@ app.config.update(
     SESSION_COOKIE_SAMESITE=None,
 )
 
+@app.before_request
+def refresh_field_types():
+    field_types.refresh(db().field_types_generation())
+
+
 @app.context_processor
 def inject_default_render_context():
     model_names = db().get_all_model_names()
@@ -39,5 +53,21 @@ def index():
     return render_template('unique/login.html')
 
 
+def resume_jobs():
+    # background jobs left unfinished by a stopped worker continue in a starting one
+    try:
+        database = new_storage()
+        resume_index_builds(database)
+        resume_migrations(database)
+    except Exception as e:
+        print('Cannot resume jobs: %s' % str(e))
+
+
+if uwsgi is not None:
+    # with --lazy-apps every worker loads the app after the fork, so the job threads run in the worker
+    resume_jobs()
+
+
 if __name__ == '__main__':
+    resume_jobs()
     app.run(debug=True)
\ No newline at end of file
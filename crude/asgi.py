@@ -0,0 +1,384 @@
+import asyncio
+import re
+from functools import partial
+from urllib.parse import parse_qs
+
+from bson.errors import InvalidId
+from bson.json_util import dumps
+from itsdangerous import BadSignature
+from pymongo.errors import ExecutionTimeout
+from werkzeug.http import parse_etags, quote_etag
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+from app import app, resume_jobs
+from blueprints.entry import foreign_relation_fields, foreign_relation_results, related_model_names, attach_related_models, related_lookups, add_related_entries, fill_related, read_etag, browse_etag
+from blueprints.helper.browsing import SEARCH_TIME_BUDGET_MS, SEARCH_TIME_GRACE, SEARCH_FUNCTIONS, search_cache
+from blueprints.helper.browsing import parse_filter, known_count, remember_count, browse_output, count_output, browse_count_time, browse_paging, keyset_position, keyset_output, search_cache_key, search_results
+from blueprints.helper.changes import CHANGE_STREAM_HEARTBEAT, SSE_HEADERS, change_hub, subscription, sse_start, sse_heartbeat, sse_message
+from blueprints.helper.common import MONGODB_URI, MONGODB_CLIENT_OPTIONS, new_storage, stream_json, join_chunks, field_types
+from persistence.async_storage import AsyncStorage
+from persistence.change_streams import Subscriber
+from persistence.client import get_async_client
+from persistence.compound_ids import field_references, plain_references
+
+# uvicorn asgi:application
+# the JSON reads, browse and search endpoints are served by async handlers on motor, so one worker can wait on
+# many queries at once and the lookups of a single request run concurrently; every other request (HTML pages,
+# writes, models, auth, status) goes to the Flask app through WsgiToAsgi
+
+if WsgiToAsgi is None:
+    raise RuntimeError('The ASGI mode needs asgiref: pip install asgiref motor uvicorn')
+
+wsgi_application = WsgiToAsgi(app)
+# every uvicorn worker imports this module
+resume_jobs()
+async_routes = []
+
+
+def async_route(pattern, json_only=False):
+    def register(handler):
+        async_routes.append((re.compile('^' + pattern + '$'), json_only, handler))
+        return handler
+    return register
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.path = scope['path']
+        self.receive = receive
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        self.cookies = {}
+        for cookie in self.headers.get('cookie', '').split(';'):
+            if '=' in cookie:
+                name, value = cookie.strip().split('=', 1)
+                self.cookies[name] = value
+
+    def is_api_call(self):
+        return self.headers.get('content-type', '').startswith('application/json')
+
+    def int_arg(self, name, default):
+        try:
+            return int(self.args.get(name, default))
+        except ValueError:
+            return default
+
+
+def logged_in(request):
+    # the session cookie of the Flask app, signed with its secret key
+    cookie = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return False
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        session = serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return False
+    return bool(session.get('wallet'))
+
+
+def not_modified(request, etag):
+    return 'if-none-match' in request.headers and parse_etags(request.headers['if-none-match']).contains(etag)
+
+
+async def send(send_message, status, body_parts, content_type='application/json', headers=None):
+    response_headers = [(b'content-type', content_type.encode()), (b'access-control-allow-origin', b'*')]
+    response_headers += [(name.encode(), value.encode()) for name, value in (headers or {}).items()]
+    await send_message({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    async for part in body_parts:
+        await send_message({'type': 'http.response.body', 'body': part.encode(), 'more_body': True})
+    await send_message({'type': 'http.response.body', 'body': b''})
+
+
+async def json_body(output):
+    for chunk in join_chunks(stream_json(output)):
+        yield chunk
+
+
+async def no_body():
+    return
+    yield
+
+
+async def application(scope, receive, send_message):
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        for pattern, json_only, handler in async_routes:
+            match = pattern.match(scope['path'])
+            if match is None:
+                continue
+            request = Request(scope, receive)
+            if json_only and not request.is_api_call():
+                break
+            if not logged_in(request):
+                await send_message({'type': 'http.response.start', 'status': 302, 'headers': [(b'location', b'/auth/login')]})
+                await send_message({'type': 'http.response.body', 'body': b''})
+                return
+            database = async_storage()
+            await refresh_field_types(database)
+            await handler(request, send_message, database, *match.groups())
+            return
+    await wsgi_application(scope, receive, send_message)
+
+
+async def refresh_field_types(database):
+    # the same as app.refresh_field_types, the module reload runs in a thread
+    generation = await database.field_types_generation()
+    if generation != field_types.generation:
+        await asyncio.to_thread(field_types.refresh, generation)
+
+
+def async_storage():
+    return AsyncStorage(get_async_client(MONGODB_URI, **MONGODB_CLIENT_OPTIONS), new_storage())
+
+
+async def send_output(send_message, output, etag=None):
+    # the same envelope as blueprints.helper.common.Response
+    headers = {}
+    if etag and output['success']:
+        headers['etag'] = quote_etag(etag)
+    await send(send_message, 200, json_body(output), headers=headers)
+
+
+async def execute(send_message, db_func, etag=None):
+    try:
+        output = {'success': True, 'error': [], 'data': await db_func()}
+    except Exception as e:
+        print('DB Error: ' + str(e))
+        output = {'success': False, 'error': [str(e)], 'data': {}}
+    await send_output(send_message, output, etag)
+
+
+@async_route('/entries/read/([^/]+)/([^/]+)', json_only=True)
+async def read(request, send_message, database, model_name, entry_id):
+    etag = await read_version(database, model_name, entry_id)
+    if etag and not_modified(request, etag):
+        await send(send_message, 304, no_body(), headers={'etag': quote_etag(etag)})
+        return
+
+    async def read_entry():
+        entry = await database.read(model_name, entry_id)
+        model = await database.read_model(model_name)
+        # the related entries and the entries referring to this one are looked up at the same time
+        (model, entry), related_entries = await asyncio.gather(resolve_related(database, model, entry), resolve_foreign_relations(database, model, entry_id))
+        return {'entry': entry, 'model_name': model_name, 'model': model, 'related_entries': related_entries}
+
+    await execute(send_message, read_entry, etag)
+
+
+async def read_version(database, model_name, entry_id):
+    try:
+        current = await database.read_revision(model_name, entry_id)
+    except InvalidId:
+        return None
+    model = await database.peek_model(model_name)
+    if current is None or model is None:
+        return None
+    return await asyncio.to_thread(read_etag, database.storage, model, current)
+
+
+async def resolve_related(database, model, entry=None):
+    related_models = {related_model['name']: related_model for related_model in await database.read_models(list(related_model_names(model)))}
+    model = attach_related_models(model, related_models)
+    if not entry:
+        return model, entry
+    # only JSON reads are served here, with whole related entries
+    related_entries, lookups = related_lookups(model, entry, True)
+    model_names = list(lookups.keys())
+    found = await asyncio.gather(*[database.find_all_ids(model_name, *lookups[model_name]).to_list(None) for model_name in model_names])
+    for model_name, entries in zip(model_names, found):
+        add_related_entries(related_entries, model_name, entries)
+    return model, fill_related(model, entry, related_entries)
+
+
+async def resolve_foreign_relations(database, model, entry_id):
+    if 'foreign_relations' not in model:
+        return {}
+    entry_compound_id = model['name'] + '/' + str(entry_id)
+    related_fields_by_model = foreign_relation_fields(model)
+    related_models = {related_model['name']: related_model for related_model in await database.read_models(list(related_fields_by_model.keys()))}
+    model_names = [model_name for model_name in related_fields_by_model if model_name in related_models]
+    lookups = []
+    for model_name in model_names:
+        references = field_references(related_models[model_name], related_fields_by_model[model_name], entry_compound_id)
+        lookups.append(database.find_relation_groups(model_name, references))
+    relation_groups = dict(zip(model_names, await asyncio.gather(*lookups)))
+    return foreign_relation_results(model, related_models, relation_groups)
+
+
+def parse_filter_args(filter_args):
+    try:
+        return parse_filter(filter_args)
+    except ValueError:
+        return {}, {}
+
+
+async def get_doc_count(database, model_name, query, max_time_ms=None):
+    # the same as blueprints.entry.get_doc_count
+    if len(query) == 0:
+        return await database.get_estimated_count(model_name)
+    known, count = known_count(model_name, query, max_time_ms)
+    if known:
+        return count
+    try:
+        count = await database.get_count(model_name, query, max_time_ms)
+    except ExecutionTimeout:
+        return None
+    remember_count(model_name, query, count)
+    return count
+
+
+@async_route('/entries/browse/([^/]+)(?:/([0-9]+))?', json_only=True)
+async def browse(request, send_message, database, model_name, page_number=None):
+    page_number = int(page_number or 1)
+    etag = await asyncio.to_thread(browse_etag, database.storage, model_name)
+    if not_modified(request, etag):
+        await send(send_message, 304, no_body(), headers={'etag': quote_etag(etag)})
+        return
+
+    async def browse_entries():
+        # the same as blueprints.entry.browse_db_func, for API calls (whole entries)
+        filter_args = request.args.get('f', '{}')
+        filter_expression, sort_doc = parse_filter_args(filter_args)
+        after, before = request.args.get('after'), request.args.get('before')
+        doc_count = await get_doc_count(database, model_name, filter_expression, browse_count_time(request.args.get('count')))
+        paging = browse_paging(request.args.get('paging'), after, before, doc_count)
+        if paging == 'page' and doc_count is None:
+            doc_count = await get_doc_count(database, model_name, filter_expression)
+        output = browse_output(model_name, filter_args, page_number, doc_count, paging)
+        if paging == 'keyset':
+            sort_list, keys, forward = keyset_position(sort_doc, after, before)
+            entries, has_more = await database.browse_keyset(model_name, filter_expression, sort_doc, keys, forward)
+            output |= keyset_output(sort_list, entries, has_more, keys, forward)
+        else:
+            output['entries'] = await database.browse(model_name, filter_expression, sort_doc, page_number).to_list(None)
+        model = await database.read_model(model_name)
+        return output | {'entries': plain_references(model, output['entries']), 'model': model}
+
+    await execute(send_message, browse_entries, etag)
+
+
+@async_route('/entries/count/([^/]+)')
+async def count(request, send_message, database, model_name):
+    filter_expression, sort_doc = parse_filter_args(request.args.get('f', '{}'))
+    output = {'success': True, 'data': count_output(model_name, await get_doc_count(database, model_name, filter_expression))}
+    await send(send_message, 200, json_body(output))
+
+
+async def search_entries(database, model_name, mode, search_term, limit, max_time_ms=None):
+    search_fields, display_fields = await database.get_search_and_display_fields(model_name)
+    cache_key = search_cache_key(model_name, mode, search_term, limit, display_fields, await database.collection_generation(model_name), await database.models_generation())
+    results = search_cache.get(cache_key)
+    if results is not None:
+        return results
+    model = await database.read_model(model_name)
+    cursor = await getattr(database, SEARCH_FUNCTIONS[mode])(model_name, search_fields, display_fields, search_term, limit)
+    if max_time_ms:
+        cursor.max_time_ms(max_time_ms)
+    results = search_results(model, await cursor.to_list(None))
+    search_cache.set(cache_key, results)
+    return results
+
+
+@async_route('/entries/search/(full-text|prefix|regex)/([^/]+)')
+async def search(request, send_message, database, mode, model_name):
+    entries = []
+    search_term = request.args.get('q')
+    if search_term:
+        entries = await search_entries(database, model_name, mode, search_term, request.int_arg('limit', 10))
+    await send(send_message, 200, json_body({'success': True, 'entries': entries}))
+
+
+@async_route('/entries/search/all')
+async def search_all(request, send_message, database):
+    mode = request.args.get('mode', 'regex')
+    limit = request.int_arg('limit', 10)
+    search_term = request.args.get('q', '')
+    model_names = request.args.get('models').split(',') if request.args.get('models') else await database.get_all_model_names()
+    if mode not in SEARCH_FUNCTIONS:
+        await send(send_message, 400, json_body({'success': False, 'error': ['Unknown search mode: %s' % mode]}))
+        return
+
+    async def search_model(model_name):
+        try:
+            return {'model': model_name, 'success': True, 'entries': await search_entries(database, model_name, mode, search_term, limit, SEARCH_TIME_BUDGET_MS)}
+        except Exception as e:
+            return {'model': model_name, 'success': False, 'error': [str(e)]}
+
+    async def generate():
+        if not search_term:
+            return
+        # one line per model, in the order the searches finish
+        tasks = {asyncio.ensure_future(search_model(model_name)): model_name for model_name in model_names}
+        try:
+            for next_result in asyncio.as_completed(tasks, timeout=SEARCH_TIME_BUDGET_MS / 1000 + SEARCH_TIME_GRACE):
+                yield dumps(await next_result) + '\n'
+        except asyncio.TimeoutError:
+            for task, model_name in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    yield dumps({'model': model_name, 'success': False, 'error': ['Search timed out']}) + '\n'
+
+    await send(send_message, 200, generate(), 'application/x-ndjson')
+
+
+class AsyncSubscriber(Subscriber):
+    # the hub thread hands the events over to the event loop of the connection
+    def __init__(self, loop, model_name, entry_id=None, filter_expression=None):
+        super().__init__(model_name, entry_id, filter_expression)
+        self.loop = loop
+        self.events = asyncio.Queue()
+
+    def deliver(self, event):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+    async def next_event(self, timeout):
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+@async_route('/entries/changes/([^/]+)(?:/([^/]+))?')
+async def changes(request, send_message, database, model_name, entry_id=None):
+    # Server-Sent Events for the entries of a model (?f= filters them like browse) or for a single entry; only served
+    # here, an open stream costs a queue and not a worker
+    new_subscriber = partial(AsyncSubscriber, asyncio.get_running_loop())
+    try:
+        subscriber = await asyncio.to_thread(subscription, database.storage, model_name, entry_id, request.args.get('f'), new_subscriber)
+    except ValueError as e:
+        await send(send_message, 400, json_body({'success': False, 'error': [str(e)], 'data': {}}))
+        return
+    event_id = request.headers.get('last-event-id') or request.args.get('last_event_id')
+    await asyncio.to_thread(change_hub.subscribe, subscriber, event_id)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request.receive))
+
+    async def generate():
+        yield sse_start()
+        while True:
+            next_event = asyncio.ensure_future(subscriber.next_event(CHANGE_STREAM_HEARTBEAT))
+            await asyncio.wait([next_event, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                next_event.cancel()
+                return
+            event = next_event.result()
+            if event is None:
+                yield sse_heartbeat()
+                continue
+            yield await asyncio.to_thread(sse_message, database.storage, event)
+            if event['type'] == 'reset':
+                return
+
+    try:
+        await send(send_message, 200, generate(), 'text/event-stream', {name.lower(): value for name, value in SSE_HEADERS.items()})
+    finally:
+        disconnected.cancel()
+        change_hub.unsubscribe(subscriber)
@@ -1,20 +1,54 @@
-from flask import Blueprint, url_for, request, render_template, g, flash
-import json
-import math
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from flask import Blueprint, url_for, request, render_template, g, flash, current_app, stream_with_context
+import os
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from bson.json_util import dumps
-from blueprints.helper.common import db
+from bson.json_util import dumps, loads
+from pymongo.errors import ExecutionTimeout
+from blueprints.helper.common import db, new_storage
 
-from blueprints.helper.common import sanitize, Response, get_input_func, get_input, render_entry, inject_field_functions
+from blueprints.helper.common import sanitize, expected_revision, Response, get_input_func, get_input, json_response, join_chunks, is_api_call, list_projection, display_projection
 
 from blueprints.auth import auth_required
+from blueprints.helper.browsing import SEARCH_TIME_BUDGET_MS, SEARCH_TIME_GRACE, SEARCH_FUNCTIONS, search_cache
+from blueprints.helper.browsing import parse_filter, known_count, remember_count, browse_output, count_output, browse_count_time, browse_paging, browse_projection, keyset_position, keyset_output, search_cache_key, search_results
+from blueprints.helper.labels import attach_related_labels, cached_label_fields, cached_related_entries, schedule_label_refresh
+from blueprints.helper.references import schedule_reference_cleanup
+from persistence.compound_ids import compound_id, split_reference, field_references, plain_references
 
 entry_blueprint = Blueprint('entry', __name__, url_prefix='/entries')
 
+SEARCH_THREADS = int(os.getenv('SEARCH_THREADS', '8'))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_MAX_REPORTED_ERRORS = 1000
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+EXPORT_CHUNK_SIZE = 64 * 1024
+BULK_OPERATIONS = ['insert', 'update', 'replace', 'delete']
 
-def get_doc_and_page_count(model_name, query, items_per_page=10):
-    count = db().get_count(model_name, query)
-    return count, math.ceil(count / items_per_page)
+search_executor = ThreadPoolExecutor(SEARCH_THREADS)
+
+
+def get_doc_count(model_name, query, max_time_ms=None):
+    # None means the count is unknown for now: the page renders without it and asks /entries/count later
+    if len(query) == 0:
+        return db().get_estimated_count(model_name)
+    known, count = known_count(model_name, query, max_time_ms)
+    if known:
+        return count
+    try:
+        count = db().get_count(model_name, query, max_time_ms)
+    except ExecutionTimeout:
+        return None
+    remember_count(model_name, query, count)
+    return count
+
+
+def parse_filter_args(filter_args):
+    try:
+        return parse_filter(filter_args)
+    except ValueError as e:
+        flash(str(e))
+        return {}, {}
 
 
 @entry_blueprint.route('/edit/<model_name>', methods=['GET'])
@@ -23,7 +57,6 @@ def get_doc_and_page_count(model_name, query, items_per_page=10):
 def edit(model_name, entry_id=None):
     model = db().read_model(model_name)
     entry = db().read(model_name, entry_id) if entry_id else False
-    model = inject_field_functions(model)
     model, entry = resolve_related(model, entry)
     render_context = {'model_name': model['name'], 'model': model, 'entry': entry, 'entry_id': entry_id if entry_id else str(ObjectId())}
     return render_template('entry/edit.html', **render_context)
@@ -43,9 +76,11 @@ def save_db_func(input_data):
     entry_id = input_data['entry_id']
     database = db()
     model = database.read_model(model_name)
-    model = inject_field_functions(model)
     sanitized_data = sanitize(model, input_data)
-    return database.save(model_name, entry_id, sanitized_data)
+    attach_related_labels(database, model, [sanitized_data])
+    result = database.save(model_name, entry_id, sanitized_data, expected_revision(input_data))
+    schedule_label_refresh(database, model_name, [entry_id])
+    return result
 
 
 @entry_blueprint.route('/read/<model_name>/<entry_id>', methods=['GET'])
@@ -53,10 +88,37 @@ def save_db_func(input_data):
 def read(model_name, entry_id):
     input_func = get_input_func(model_name=model_name, entry_id=entry_id)
     res = Response(input_func, read_db_func, read_view_data)
+    res.version_func = read_version
     res.template = 'entry/read.html'
     return res.execute()
 
 
+def read_version(input_data):
+    database = db()
+    try:
+        current = database.read_revision(input_data['model_name'], input_data['entry_id'])
+    except InvalidId:
+        return None
+    model = database.peek_model(input_data['model_name'])
+    if current is None or model is None:
+        return None
+    return read_etag(database, model, current)
+
+
+def read_etag(database, model, current):
+    # the read holds the related entries and the entries referring to this one
+    version = [current.get('_rev', 0), database.models_generation()]
+    version += [database.collection_generation(model_name) for model_name in page_model_names(model)]
+    return '-'.join(str(part) for part in version)
+
+
+def page_model_names(model):
+    model_names = {model['name']}
+    model_names.update(field['related_model'] for field in model['fields'] if field['type'] == 'related')
+    model_names.update(foreign_relation['related_model'] for foreign_relation in model.get('foreign_relations', []))
+    return sorted(model_names)
+
+
 def read_db_func(input_data):
     return {'entry': db().read(input_data['model_name'], input_data['entry_id'])}
 
@@ -66,7 +128,6 @@ def read_view_data(input_data):
     entry_id = input_data['entry_id']
     entry = input_data['entry']
     model = db().read_model(model_name)
-    model = inject_field_functions(model)
     model, entry = resolve_related(model, entry)
     related_entries = resolve_foreign_relations(model, entry_id)
     view_data = {'model_name': model_name, 'model': model, 'entry': entry, 'related_entries': related_entries}
@@ -85,7 +146,10 @@ def delete(model_name, entry_id):
 
 def delete_db_func(input_data):
     #print('delete_db_func: ', input_data)
-    return db().delete(input_data['model_name'], input_data['entry_id'])
+    result = db().delete(input_data['model_name'], input_data['entry_id'])
+    if result['affected'] > 0:
+        schedule_reference_cleanup(db(), input_data['model_name'], [input_data['entry_id']])
+    return result
 
 
 @entry_blueprint.route('/browse/<model_name>', methods=['GET'])
@@ -95,97 +159,339 @@ def browse(model_name, page_number=1):
     input_func = get_input_func(
         model_name=model_name,
         page_number=page_number,
-        filter_args=request.args.get('f', '{}')
+        filter_args=request.args.get('f', '{}'),
+        paging=request.args.get('paging'),
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        count=request.args.get('count')
     )
     res = Response(input_func, browse_db_func, browse_view_data)
+    res.version_func = browse_version
     res.template = 'entry/browse.html'
     return res.execute()
 
 
+def browse_version(input_data):
+    return browse_etag(db(), input_data['model_name'])
+
+
+def browse_etag(database, model_name):
+    return 'b%d-%d' % (database.collection_generation(model_name), database.models_generation())
+
+
 def browse_view_data(input_data):
     model = db().read_model(input_data['model_name'])
-    model = inject_field_functions(model)
     return {'model': model}
 
 
 def browse_db_func(input_data):
     #print('browse_db_func: ', input_data)
-    sort_doc = {}
-    try:
-        filter_expression = json.loads(input_data['filter_args'])
-        #print('filter_expression: ', filter_expression)
-        if 'sort' in filter_expression:
-            sort_doc = filter_expression['sort']
-            del filter_expression['sort']
-    except json.decoder.JSONDecodeError as e:
-        filter_expression = {}
-        flash(str(e))
-        #print('browse_db_func: ', str(e))
+    model_name = input_data['model_name']
+    filter_expression, sort_doc = parse_filter_args(input_data['filter_args'])
+    after, before = input_data.get('after'), input_data.get('before')
+    doc_count = get_doc_count(model_name, filter_expression, browse_count_time(input_data.get('count')))
+    paging = browse_paging(input_data.get('paging'), after, before, doc_count)
+    if paging == 'page' and doc_count is None:
+        doc_count = get_doc_count(model_name, filter_expression)
+    output = browse_output(model_name, input_data['filter_args'], input_data['page_number'], doc_count, paging)
+    model = db().read_model(model_name)
+    projection_fields, truncate = browse_projection(model, sort_doc, is_api_call())
+    if paging == 'keyset':
+        sort_list, keys, forward = keyset_position(sort_doc, after, before)
+        entries, has_more = db().browse_keyset(model_name, filter_expression, sort_doc, keys, forward, projection_fields=projection_fields, truncate=truncate)
+        output |= keyset_output(sort_list, entries, has_more, keys, forward)
+    else:
+        output['entries'] = db().browse(model_name, filter_expression, sort_doc, input_data['page_number'], projection_fields=projection_fields, truncate=truncate)
+    return output | {'entries': plain_references(model, output['entries'])}
 
-    entries = db().browse(input_data['model_name'], filter_expression, sort_doc, input_data['page_number'])
-    doc_count, page_count = get_doc_and_page_count(input_data['model_name'], filter_expression)
-    return {'filter_expression': input_data['filter_args'], 'doc_count': doc_count, 'entries': entries, 'page_count': page_count, 'current_page': input_data['page_number'], 'model_name': input_data['model_name']}
 
+@entry_blueprint.route('/count/<model_name>', methods=['GET'])
+@auth_required
+def count(model_name):
+    filter_expression, sort_doc = parse_filter_args(request.args.get('f', '{}'))
+    return {'success': True, 'data': count_output(model_name, get_doc_count(model_name, filter_expression))}
+
+
+@entry_blueprint.route('/changes/<model_name>', methods=['GET'])
+@entry_blueprint.route('/changes/<model_name>/<entry_id>', methods=['GET'])
+@auth_required
+def changes(model_name, entry_id=None):
+    # the Server-Sent Events streams are served by asgi.changes; here an open stream would hold a whole worker
+    # process for as long as the client stays connected (and EventSource reconnects by itself)
+    return {'success': False, 'error': ['Live changes are only served in the ASGI mode'], 'data': {}}, 501
 
-def execute_search(model_name, search_function):
+
+@entry_blueprint.route('/import/<model_name>', methods=['POST'])
+@auth_required
+def import_entries(model_name):
+    database = db()
+    model = database.read_model(model_name)
+    if not model:
+        return {'success': False, 'error': ['Unknown model: %s' % model_name], 'data': {}}, 404
+    report = {'inserted': 0, 'failed': 0, 'errors': []}
+    batch = []
+    batch_lines = []
+    for line_number, line in enumerate(request.stream, start=1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            document = loads(line)
+            entry = sanitize(model, document)
+            if '_id' in document:
+                entry['_id'] = ObjectId(document['_id'])
+        except Exception as e:
+            add_import_error(report, line_number, str(e))
+            continue
+        batch.append(entry)
+        batch_lines.append(line_number)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            import_batch(database, model, batch, batch_lines, report)
+            batch = []
+            batch_lines = []
+    if len(batch) > 0:
+        import_batch(database, model, batch, batch_lines, report)
+    return {'success': report['failed'] == 0, 'error': [], 'data': report}
+
+
+def import_batch(database, model, batch, batch_lines, report):
+    model_name = model['name']
+    attach_related_labels(database, model, batch)
+    result = database.insert_many(model_name, batch)
+    report['inserted'] += result['inserted']
+    for error in result['errors']:
+        add_import_error(report, batch_lines[error['index']], error['error'])
+
+
+def add_import_error(report, line_number, message):
+    report['failed'] += 1
+    if len(report['errors']) < IMPORT_MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line_number, 'error': message})
+
+
+@entry_blueprint.route('/bulk/<model_name>', methods=['POST'])
+@auth_required
+def bulk(model_name):
+    payload = request.get_json(silent=True)
+    ordered = True
+    operations = payload
+    if isinstance(payload, dict):
+        ordered = bool(payload.get('ordered', True))
+        operations = payload.get('operations', [])
+    if not isinstance(operations, list):
+        return {'success': False, 'error': ['Expected a JSON list of operations or {"operations": [...], "ordered": ...}'], 'data': {}}, 400
+    database = db()
+    model = database.read_model(model_name)
+    if not model:
+        return {'success': False, 'error': ['Unknown model: %s' % model_name], 'data': {}}, 404
+    prepared = []
+    validation_errors = {}
+    for index, operation in enumerate(operations):
+        try:
+            prepared.append((index, prepare_bulk_operation(model, operation)))
+        except KeyError as e:
+            validation_errors[index] = 'Missing key: %s' % e.args[0]
+        except (TypeError, ValueError, InvalidId) as e:
+            validation_errors[index] = str(e)
+        if ordered and index in validation_errors:
+            break
+    if len(cached_label_fields(model)) > 0:
+        attach_related_labels(database, model, [operation['data'] for index, operation in prepared if operation['op'] in ['insert', 'replace']])
+        attach_related_labels(database, model, [operation['data'] for index, operation in prepared if operation['op'] == 'update'], dotted=True)
+    result = database.bulk_write(model_name, [operation for index, operation in prepared], ordered)
+    write_errors = {prepared[position][0]: message for position, message in result['errors'].items()}
+    failed = sorted(list(validation_errors.keys()) + list(write_errors.keys()))
+    # an ordered bulk stops at the first failing operation
+    stopped_at = failed[0] if ordered and len(failed) > 0 else None
+    changed_ids = [operation['_id'] for index, operation in prepared if operation['op'] in ['update', 'replace'] and index not in write_errors and (stopped_at is None or index < stopped_at)]
+    schedule_label_refresh(database, model_name, changed_ids)
+    deleted_ids = [operation['_id'] for index, operation in prepared if operation['op'] == 'delete' and index not in write_errors and (stopped_at is None or index < stopped_at)]
+    schedule_reference_cleanup(database, model_name, deleted_ids)
+    ids = {index: operation['_id'] for index, operation in prepared}
+    results = []
+    for index, operation in enumerate(operations):
+        op_result = {'index': index, 'op': operation.get('op') if isinstance(operation, dict) else None, 'success': False}
+        if index in ids:
+            op_result['_id'] = str(ids[index])
+        if index in validation_errors:
+            op_result['error'] = validation_errors[index]
+        elif index in write_errors:
+            op_result['error'] = write_errors[index]
+        elif stopped_at is not None and index > stopped_at:
+            op_result['error'] = 'Not executed, an earlier operation failed'
+        else:
+            op_result['success'] = True
+        results.append(op_result)
+    output = {'ordered': ordered, 'counts': result['counts'], 'results': results}
+    return {'success': len(failed) == 0, 'error': [], 'data': output}
+
+
+def prepare_bulk_operation(model, operation):
+    op = operation['op']
+    if op not in BULK_OPERATIONS:
+        raise ValueError('Unknown operation: %s' % op)
+    if op == 'insert':
+        entry_id = ObjectId(operation['_id']) if '_id' in operation else ObjectId()
+    else:
+        entry_id = ObjectId(operation['_id'])
+    data = {}
+    if op != 'delete':
+        data = sanitize(model, operation['data'])
+        if op == 'update' and len(data) == 0:
+            raise ValueError('No model fields to update')
+    return {'op': op, '_id': entry_id, 'data': data}
+
+
+@entry_blueprint.route('/export/<model_name>', methods=['GET'])
+@auth_required
+def export_entries(model_name):
+    model = db().read_model(model_name)
+    if not model:
+        return {'success': False, 'error': ['Unknown model: %s' % model_name], 'data': {}}, 404
+    filter_expression, sort_doc = parse_filter_args(request.args.get('f', '{}'))
+    cursor = db().export(model_name, filter_expression, sort_doc, EXPORT_BATCH_SIZE)
+    # exports can be imported again, so references are written as compound ids
+    entries = plain_references(model, cursor)
+
+    def generate():
+        for entry in entries:
+            yield dumps(entry) + '\n'
+
+    headers = {'Content-Disposition': 'attachment; filename=%s.ndjson' % model_name}
+    return current_app.response_class(stream_with_context(join_chunks(generate(), EXPORT_CHUNK_SIZE)), mimetype='application/x-ndjson', headers=headers)
+
+
+def execute_search(model_name, mode):
     entries = []
-    limit = request.args.get('limit', 10)
-    search_fields, display_fields = db().get_search_and_display_fields(model_name)
+    limit = request.args.get('limit', 10, type=int)
     search_term = request.args.get('q', False)
     if search_term:
-        model = db().read_model(model_name)
-        entries = search_function(model_name, search_fields, display_fields, search_term, limit)
-        entries = map(lambda entry: entry | {'_to_string': render_entry(model, entry)}, entries)
-    return dumps({'success': True, 'entries': entries})
+        entries = search_entries(db(), model_name, mode, search_term, limit)
+    return json_response({'success': True, 'entries': entries})
+
+
+def search_entries(database, model_name, mode, search_term, limit, max_time_ms=None):
+    search_fields, display_fields = database.get_search_and_display_fields(model_name)
+    cache_key = search_cache_key(model_name, mode, search_term, limit, display_fields, database.collection_generation(model_name), database.models_generation())
+    results = search_cache.get(cache_key)
+    if results is not None:
+        return results
+    model = database.read_model(model_name)
+    search_function = getattr(database, SEARCH_FUNCTIONS[mode])
+    entries = search_function(model_name, search_fields, display_fields, search_term, limit)
+    if max_time_ms:
+        entries.max_time_ms(max_time_ms)
+    results = search_results(model, entries)
+    search_cache.set(cache_key, results)
+    return results
+
+
+def search_entries_in_thread(model_name, mode, search_term, limit):
+    return search_entries(new_storage(), model_name, mode, search_term, limit, SEARCH_TIME_BUDGET_MS)
 
 
 @entry_blueprint.route('/search/full-text/<model_name>', methods=['GET'])
 @auth_required
 def full_text_search(model_name):
-    return execute_search(model_name, db().full_text_search)
+    return execute_search(model_name, 'full-text')
 
 
 @entry_blueprint.route('/search/prefix/<model_name>', methods=['GET'])
 @auth_required
 def prefix_search(model_name):
-    return execute_search(model_name, db().prefix_search)
+    return execute_search(model_name, 'prefix')
 
 
 @entry_blueprint.route('/search/regex/<model_name>', methods=['GET'])
 @auth_required
 def regex_search(model_name):
-    return execute_search(model_name, db().regex_search)
+    return execute_search(model_name, 'regex')
+
+
+@entry_blueprint.route('/search/all', methods=['GET'])
+@auth_required
+def search_all():
+    mode = request.args.get('mode', 'regex')
+    limit = request.args.get('limit', 10, type=int)
+    search_term = request.args.get('q', '')
+    model_names = request.args.get('models').split(',') if request.args.get('models') else db().get_all_model_names()
+    if mode not in SEARCH_FUNCTIONS:
+        return {'success': False, 'error': ['Unknown search mode: %s' % mode]}, 400
+
+    def generate():
+        if not search_term:
+            return
+        # one line per model, in the order the searches finish
+        futures = {search_executor.submit(search_entries_in_thread, model_name, mode, search_term, limit): model_name for model_name in model_names}
+        try:
+            for future in as_completed(futures, timeout=SEARCH_TIME_BUDGET_MS / 1000 + SEARCH_TIME_GRACE):
+                try:
+                    yield dumps({'model': futures[future], 'success': True, 'entries': future.result()}) + '\n'
+                except Exception as e:
+                    yield dumps({'model': futures[future], 'success': False, 'error': [str(e)]}) + '\n'
+        except TimeoutError:
+            for future, model_name in futures.items():
+                if not future.done():
+                    future.cancel()
+                    yield dumps({'model': model_name, 'success': False, 'error': ['Search timed out']}) + '\n'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 def resolve_foreign_relations(model, entry_id):
     if 'foreign_relations' not in model:
         return {}
-    compound_id = model['name'] + '/' + str(entry_id)
-    foreign_relations = model['foreign_relations']
+    entry_compound_id = model['name'] + '/' + str(entry_id)
+    database = db()
+    # one aggregation per related model, covering all of its relation fields
+    related_fields_by_model = foreign_relation_fields(model)
+    related_models = {related_model['name']: related_model for related_model in database.read_models(list(related_fields_by_model.keys()))}
+    relation_groups = {}
+    for model_name, related_fields in related_fields_by_model.items():
+        if model_name in related_models:
+            # API callers get whole entries, pages only the list fields with long texts cut short
+            projection_fields, truncate = (None, None) if is_api_call() else list_projection(related_models[model_name])
+            references = field_references(related_models[model_name], related_fields, entry_compound_id)
+            relation_groups[model_name] = database.find_relation_groups(model_name, references, projection_fields=projection_fields, truncate=truncate)
+    return foreign_relation_results(model, related_models, relation_groups)
+
+
+def foreign_relation_fields(model):
+    related_fields_by_model = {}
+    for foreign_relation in model['foreign_relations']:
+        related_fields = related_fields_by_model.setdefault(foreign_relation['related_model'], [])
+        if foreign_relation['related_field'] not in related_fields:
+            related_fields.append(foreign_relation['related_field'])
+    return related_fields_by_model
+
+
+def foreign_relation_results(model, related_models, relation_groups):
     results = []
-    # TODO: optimize this by grouping the calls by model_name
-    for foreign_relation in foreign_relations:
-        name = foreign_relation['name']
-        database = db()
-        related_entries = list(database.find_relations(foreign_relation['related_model'], foreign_relation['related_field'], compound_id))
-        if len(related_entries) > 0:
-            related_model = database.read_model(foreign_relation['related_model'])
-            related_model = inject_field_functions(related_model)
+    for foreign_relation in model['foreign_relations']:
+        relation_group = relation_groups.get(foreign_relation['related_model'], {}).get(foreign_relation['related_field'])
+        if relation_group and relation_group['count'] > 0:
+            related_model = related_models[foreign_relation['related_model']]
             results.append({
-                'name': name,
+                'name': foreign_relation['name'],
                 'related_model': related_model,
-                'entries': related_entries
+                'entries': plain_references(related_model, relation_group['entries']),
+                'count': relation_group['count']
             })
     return results
 
 
 def resolve_related_models(model):
-    related_models_to_field_map = {field['related_model']: idx for idx, field in enumerate(model['fields']) if field['type'] == 'related' and field['related_model']}
-    related_models = db().read_models(list(related_models_to_field_map.keys()))
-    for related_model in related_models:
-        related_model_name = related_model['name']
-        field_index = related_models_to_field_map[related_model_name]
-        model['fields'][field_index]['related_model'] = related_model
+    related_models = {related_model['name']: related_model for related_model in db().read_models(list(related_model_names(model)))}
+    return attach_related_models(model, related_models)
+
+
+def related_model_names(model):
+    return {field['related_model'] for field in model['fields'] if field['type'] == 'related' and field['related_model']}
+
+
+def attach_related_models(model, related_models):
+    for field in model['fields']:
+        if field['type'] == 'related' and field['related_model'] in related_models:
+            field['related_model'] = related_models[field['related_model']]
     return model
 
 
@@ -193,35 +499,46 @@ def resolve_related(model, entry=None):
     model = resolve_related_models(model)
     if not entry:
         return model, entry
+    related_entries, lookups = related_lookups(model, entry, is_api_call())
+    # query the database for the related entries, once per related model
+    for model_name, (ids, projection_fields, truncate) in lookups.items():
+        add_related_entries(related_entries, model_name, db().find_all_ids(model_name, ids, projection_fields, truncate))
+    return model, fill_related(model, entry, related_entries)
+
+
+def related_lookups(model, entry, whole_entries=False):
+    # the related entries known from cached labels, and for the rest: model name -> (ids, projection, truncate);
+    # pages only need the display fields, whole_entries (API calls) skips the projection
     related_fields = [field for field in model['fields'] if field['type'] == 'related']
-    info_map = {}
-    related_entries_by_field = {}
-    related_models_by_field = {}
-    query_ids_per_model = {}
-    models_by_name = {}
+    # fields with cached labels only need a lookup for ids that have no label yet
+    related_entries = {}
+    for field in related_fields:
+        if field.get('cache_labels'):
+            related_entries |= cached_related_entries(entry, field['name'])
+    ids_per_model = {}
     for field in related_fields:
-        if entry and entry[field['name']] and len(entry[field['name']]) > 0:
-            related_model = field['related_model']
-            models_by_name[related_model['name']] = related_model
-            model_ids = [compound_id.split('/')[1] for compound_id in entry[field['name']]]
-            info_map |= {compound_id: source_field for compound_id, source_field in map(lambda x: (x, field['name']), entry[field['name']])}
-            if related_model['name'] not in query_ids_per_model:
-                query_ids_per_model[related_model['name']] = []
-            query_ids_per_model[related_model['name']] += model_ids
-    # query the database for the related entries
-    for model_name, ids in query_ids_per_model.items():
-        related_model = models_by_name[model_name]
-        entry_cursor = db().find_all_ids(model_name, ids)
-        for related_entry in entry_cursor:
-            entry_id = str(related_entry['_id'])
-            related_entry['_id'] = entry_id
-            compound_id = model_name + '/' + entry_id
-            source_field = info_map[compound_id]
-            related_models_by_field[source_field] = related_model
-            if source_field not in related_entries_by_field:
-                related_entries_by_field[source_field] = []
-            related_entries_by_field[source_field].append(related_entry)
+        for reference in entry.get(field['name']) or []:
+            if compound_id(reference) in related_entries:
+                continue
+            model_name, entry_id = split_reference(reference)
+            ids_per_model.setdefault(model_name, set()).add(entry_id)
+    related_models = {field['related_model']['name']: field['related_model'] for field in related_fields if isinstance(field['related_model'], dict)}
+    lookups = {}
+    for model_name, ids in ids_per_model.items():
+        projection_fields, truncate = display_projection(related_models[model_name]) if model_name in related_models and not whole_entries else (None, None)
+        lookups[model_name] = (list(ids), projection_fields, truncate)
+    return related_entries, lookups
+
+
+def add_related_entries(related_entries, model_name, entries):
+    for related_entry in entries:
+        related_entry['_id'] = str(related_entry['_id'])
+        related_entries[model_name + '/' + related_entry['_id']] = related_entry
+
+
+def fill_related(model, entry, related_entries):
     for field in model['fields']:
         if field['type'] == 'related':
-            entry[field['name']] = related_entries_by_field[field['name']] if field['name'] in related_entries_by_field else []
-    return model, entry
\ No newline at end of file
+            compound_ids = [compound_id(reference) for reference in entry.get(field['name']) or []]
+            entry[field['name']] = [related_entries[field_compound_id] for field_compound_id in compound_ids if field_compound_id in related_entries]
+    return entry
@@ -0,0 +1,112 @@
+import json
+import os
+
+from bson.json_util import dumps
+
+from blueprints.helper.common import render_entries, list_projection
+from persistence.cache import TTLCache, new_cache
+from persistence.compound_ids import plain_references
+from persistence.keyset import keyset_sort, encode_token, decode_token
+
+# the browse, count and search logic shared by blueprints.entry (pymongo) and asgi (motor); the database calls stay
+# with the callers
+
+KEYSET_PAGINATION_THRESHOLD = int(os.getenv('KEYSET_PAGINATION_THRESHOLD', '10000'))
+COUNT_TIME_BUDGET_MS = int(os.getenv('COUNT_TIME_BUDGET_MS', '200'))
+COUNT_CACHE_TTL = float(os.getenv('COUNT_CACHE_TTL', '10'))
+SEARCH_TIME_BUDGET_MS = int(os.getenv('SEARCH_TIME_BUDGET_MS', '1000'))
+SEARCH_TIME_GRACE = 0.5
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '1024'))
+SEARCH_CACHE_UWSGI = os.getenv('SEARCH_CACHE_UWSGI')
+SEARCH_FUNCTIONS = {'full-text': 'full_text_search', 'prefix': 'prefix_search', 'regex': 'regex_search'}
+
+count_cache = TTLCache(COUNT_CACHE_TTL)
+search_cache = new_cache(SEARCH_CACHE_SIZE, SEARCH_CACHE_UWSGI)
+
+
+def parse_filter(filter_args):
+    # the filter expression and the sort of ?f=, raises ValueError for invalid JSON
+    filter_expression = json.loads(filter_args)
+    sort_doc = filter_expression.pop('sort', {})
+    return filter_expression, sort_doc
+
+
+def count_cache_key(model_name, query):
+    return model_name, dumps(query, sort_keys=True)
+
+
+def known_count(model_name, query, max_time_ms=None):
+    # (True, count) when it takes no count query: a cached count, or None (unknown for now) when there is no time
+    # for one; (False, None) otherwise
+    count = count_cache.get(count_cache_key(model_name, query))
+    if count is not None or max_time_ms == 0:
+        return True, count
+    return False, None
+
+
+def remember_count(model_name, query, count):
+    count_cache.set(count_cache_key(model_name, query), count)
+
+
+def page_count(doc_count, items_per_page=10):
+    return None if doc_count is None else -(-doc_count // items_per_page)
+
+
+def browse_output(model_name, filter_args, page_number, doc_count, paging):
+    return {'filter_expression': filter_args, 'doc_count': doc_count, 'page_count': page_count(doc_count), 'current_page': page_number, 'model_name': model_name, 'paging': paging}
+
+
+def count_output(model_name, doc_count):
+    return {'doc_count': doc_count, 'page_count': page_count(doc_count), 'model_name': model_name}
+
+
+def browse_count_time(count_mode):
+    # ?count=deferred renders the page at once, the count is asked for with /entries/count later
+    return 0 if count_mode == 'deferred' else COUNT_TIME_BUDGET_MS
+
+
+def browse_paging(paging, after, before, doc_count):
+    # 'keyset' or 'page'; without an explicit choice, keyset paging for tokens, unknown and large counts
+    if paging in ['keyset', 'page']:
+        return paging
+    use_keyset = after or before or doc_count is None or doc_count > KEYSET_PAGINATION_THRESHOLD
+    return 'keyset' if use_keyset else 'page'
+
+
+def browse_projection(model, sort_doc, whole_entries=False):
+    # API callers get whole documents, the HTML list only needs the model fields with long texts cut short
+    if whole_entries:
+        return None, None
+    projection_fields, truncate = list_projection(model)
+    projection_fields += [field for field in sort_doc.keys() if field not in projection_fields]
+    truncate = {field: length for field, length in truncate.items() if field not in sort_doc}
+    return projection_fields, truncate
+
+
+def keyset_position(sort_doc, after_token=None, before_token=None):
+    # tokens carry the sort keys of the first/last entry on the page, so every page is a range scan on the sort index
+    sort_list = keyset_sort(sort_doc)
+    forward = not before_token
+    token = after_token if forward else before_token
+    keys = decode_token(sort_list, token) if token else None
+    return sort_list, keys, forward
+
+
+def keyset_output(sort_list, entries, has_more, keys, forward):
+    has_next = has_more if forward else keys is not None
+    has_prev = keys is not None if forward else has_more
+    return {
+        'entries': entries,
+        'next_token': encode_token(sort_list, entries[-1]) if has_next and len(entries) > 0 else None,
+        'prev_token': encode_token(sort_list, entries[0]) if has_prev and len(entries) > 0 else None
+    }
+
+
+def search_cache_key(model_name, mode, search_term, limit, display_fields, collection_generation, models_generation):
+    # any write to the collection or change of a model moves the generations on, so old results are never hit again
+    return model_name, mode, search_term, limit, tuple(display_fields), collection_generation, models_generation
+
+
+def search_results(model, entries):
+    return [entry | {'_to_string': label} for entry, label in render_entries(model, plain_references(model, entries))]
+
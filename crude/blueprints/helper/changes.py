@@ -0,0 +1,60 @@
+import json
+import os
+
+from bson.errors import InvalidId
+from bson.json_util import dumps
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+from blueprints.helper.common import new_storage
+from persistence.change_streams import ChangeHub, Subscriber
+from persistence.compound_ids import plain_references
+
+CHANGE_STREAM_BUFFER_SIZE = int(os.getenv('CHANGE_STREAM_BUFFER_SIZE', '1000'))
+CHANGE_STREAM_MAX_BACKLOG = int(os.getenv('CHANGE_STREAM_MAX_BACKLOG', '1000'))
+CHANGE_STREAM_HEARTBEAT = float(os.getenv('CHANGE_STREAM_HEARTBEAT', '15'))
+CHANGE_STREAM_RETRY_MS = int(os.getenv('CHANGE_STREAM_RETRY_MS', '3000'))
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+change_hub = ChangeHub(new_storage, CHANGE_STREAM_BUFFER_SIZE, CHANGE_STREAM_MAX_BACKLOG)
+
+
+def subscription(database, model_name, entry_id=None, filter_args=None, new_subscriber=Subscriber):
+    # the subscriber for a request, raises ValueError for an unknown model, entry id or a broken filter
+    if database.peek_model(model_name) is None:
+        raise ValueError('Unknown model: %s' % model_name)
+    try:
+        entry_id = ObjectId(entry_id) if entry_id else None
+    except InvalidId:
+        raise ValueError('Invalid entry id: %s' % entry_id)
+    try:
+        filter_expression = json.loads(filter_args or '{}')
+    except json.decoder.JSONDecodeError as e:
+        raise ValueError(str(e))
+    filter_expression.pop('sort', None)
+    if filter_expression:
+        # an invalid filter fails here and not once per change
+        try:
+            database.matches_filter(model_name, None, filter_expression)
+        except OperationFailure as e:
+            raise ValueError(str(e))
+    return new_subscriber(model_name, entry_id, filter_expression)
+
+
+def sse_start():
+    return 'retry: %d\n\n' % CHANGE_STREAM_RETRY_MS
+
+
+def sse_heartbeat():
+    return ': heartbeat\n\n'
+
+
+def sse_message(database, event):
+    # an event without id (a reset that cannot be resumed from) clears the Last-Event-ID of the client
+    data = {'model': event['model'], '_id': event['_id'], 'entry': event['entry']}
+    if event['entry'] is not None:
+        # the event is shared by all subscribers, the model is the cached one (read-only)
+        data['entry'] = plain_references(database.peek_model(event['model']), [dict(event['entry'])])[0]
+    if event['type'] == 'reset':
+        data['reason'] = event['reason']
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (event['id'] or '', event['type'], dumps(data))
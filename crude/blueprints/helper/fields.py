@@ -0,0 +1,125 @@
+import importlib
+import json
+import os
+import threading
+from functools import partial
+
+from persistence.compound_ids import compound_id, stored_reference
+
+BUILTIN_FIELD_TYPES = ['related', 'checkbox', 'color', 'date', 'datetime-local', 'email', 'file', 'hidden', 'image', 'month', 'number', 'password', 'range', 'tel', 'text', 'time', 'url', 'week']
+
+
+class FieldTypes:
+    # the extended field types: a template in templates/fields and a class of the same name in fields/
+    def __init__(self):
+        self.classes = {}
+        self.version = 0
+        self.generation = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def load(self, reload_modules=False):
+        current_script_dir = os.path.dirname(os.path.abspath(__file__))
+        python_path = os.path.abspath(os.path.join(current_script_dir, '../../fields'))
+        template_path = os.path.abspath(os.path.join(current_script_dir, '../../templates/fields'))
+        classes = {}
+        for filename in os.listdir(template_path):
+            field_type = filename.split('.')[0]
+            if os.path.isfile(os.path.join(python_path, field_type + '.py')):
+                field_module = importlib.import_module('fields.' + field_type)
+                if reload_modules:
+                    field_module = importlib.reload(field_module)
+                if hasattr(field_module, field_type.capitalize()):
+                    classes[field_type] = getattr(field_module, field_type.capitalize())
+        with self.lock:
+            self.classes = classes
+            self.version += 1
+        return self
+
+    def reload(self):
+        # picks up new or changed field types without a restart, cached field plans are rebuilt on next use
+        return self.load(reload_modules=True)
+
+    def refresh(self, generation):
+        # reloads when the field types generation in _meta moved on (flask model reload-field-types), so every
+        # worker picks up the change; the first generation seen belongs to the field types loaded at start
+        if generation == self.generation:
+            return
+        with self.refresh_lock:
+            if generation == self.generation:
+                return
+            if self.generation is not None:
+                self.reload()
+            self.generation = generation
+
+    def get(self, field_type):
+        return self.classes.get(field_type)
+
+    def is_valid(self, field_type):
+        return field_type in self.classes or field_type in BUILTIN_FIELD_TYPES
+
+    def __contains__(self, field_type):
+        return field_type in self.classes
+
+    def __iter__(self):
+        return iter(list(self.classes.keys()))
+
+
+class FieldPlan:
+    # everything the request handlers need per field, resolved once per model version:
+    # sanitizers convert input values, short_strings render display fields, truncate limits long values in lists
+    def __init__(self, model, field_types):
+        self.sanitizers = []
+        self.short_strings = {}
+        self.truncate = {}
+        self.field_names = []
+        for field in model['fields']:
+            field_name = field['name']
+            field_class = field_types.get(field['type'])
+            self.field_names.append(field_name)
+            if field_class:
+                self.sanitizers.append((field_name, partial(extended_value, field_class.input_to_json_value, field)))
+                self.short_strings[field_name] = partial(field_class.json_to_short_string, field)
+                if hasattr(field_class, 'LIST_MAX_LENGTH'):
+                    self.truncate[field_name] = field_class.LIST_MAX_LENGTH
+            elif field['type'] == 'related':
+                self.sanitizers.append((field_name, safe_converter(partial(related_references, field))))
+                self.short_strings[field_name] = partial(plain_short_string, field_name)
+            else:
+                self.sanitizers.append((field_name, safe_converter(BUILTIN_CONVERTERS.get(field['type'], str))))
+                self.short_strings[field_name] = partial(plain_short_string, field_name)
+
+    def sanitize(self, input_for_entry):
+        return {field_name: sanitizer(input_for_entry[field_name]) for field_name, sanitizer in self.sanitizers if field_name in input_for_entry}
+
+
+def extended_value(input_to_json_value, field, value):
+    return input_to_json_value(field, {field['name']: value})
+
+
+def plain_short_string(field_name, entry):
+    return str(entry[field_name])
+
+
+def safe_converter(converter):
+    def convert(value):
+        if value == '':
+            return None
+        try:
+            return converter(value)
+        except:
+            return None
+    return convert
+
+
+def related_value(value):
+    if isinstance(value, list):
+        return [compound_id(reference) for reference in value]
+    return [search_entry['value'] for search_entry in json.loads(value)]
+
+
+def related_references(field, value):
+    return [stored_reference(field, reference) for reference in related_value(value)]
+
+
+BUILTIN_CONVERTERS = {'number': float, 'checkbox': bool}
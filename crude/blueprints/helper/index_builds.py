@@ -0,0 +1,101 @@
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from blueprints.helper.common import new_storage
+from persistence.indexes import declared_indexes, existing_indexes, index_plan
+from persistence.jobs import JobQueue
+
+INDEX_BUILD_JOB = 'index-build'
+INDEX_BUILD_TIMEOUT = float(os.getenv('INDEX_BUILD_TIMEOUT', '86400'))
+INDEX_BUILD_LEASE_SECONDS = 60
+
+index_build_jobs = JobQueue('index-builds')
+
+# index builds are tracked in the _jobs collection:
+# {'type': 'index-build', 'model': name, 'status': 'queued'|'running'|'done'|'failed', 'steps': [...], 'done': n, 'error': ...,
+#  'lease_until': ...}
+
+
+def plan_index_build(database, model):
+    return index_plan(declared_indexes(model), existing_indexes(database.list_indexes(model['name'])))
+
+
+def schedule_index_build(database, model_name):
+    job_id = database.create_job(INDEX_BUILD_JOB, model_name)
+    index_build_jobs.submit(job_id, run_index_build, job_id)
+    return job_id
+
+
+def resume_index_builds(database):
+    # the plan is made again when the job runs, so a resumed build only does the steps that are left
+    for job in database.find_resumable_jobs(INDEX_BUILD_JOB):
+        index_build_jobs.submit(job['_id'], run_index_build, job['_id'])
+
+
+def run_index_build(job_id):
+    database = new_storage()
+    job = database.claim_job(job_id, '%s:%s' % (socket.gethostname(), os.getpid()), INDEX_BUILD_LEASE_SECONDS)
+    if job is None:
+        # finished or running elsewhere
+        return
+    database.update_job(job_id, {'started': datetime.utcnow()})
+    # a single index build can outlast the lease, so it is renewed in the background until the job ends
+    stop = threading.Event()
+    renewal = threading.Thread(target=renew_lease, args=(database, job_id, stop), name='index-build-lease', daemon=True)
+    renewal.start()
+    try:
+        build_indexes(database, job['model'], job_id)
+        error = None
+    except Exception as e:
+        error = str(e)
+    stop.set()
+    renewal.join()
+    database.update_job(job_id, {'status': 'failed' if error else 'done', 'error': error, 'finished': datetime.utcnow(), 'lease_until': None})
+    if error:
+        print('Index build of %s failed: %s' % (job['model'], error))
+
+
+def renew_lease(database, job_id, stop):
+    while not stop.wait(INDEX_BUILD_LEASE_SECONDS / 3):
+        database.update_job(job_id, {'lease_until': datetime.utcnow() + timedelta(seconds=INDEX_BUILD_LEASE_SECONDS)})
+
+
+def build_indexes(database, model_name, job_id=None):
+    # the plan is made when the job runs, so it always works towards the latest saved model
+    model = database.read_model(model_name)
+    if not model:
+        return []
+    steps = plan_index_build(database, model)
+    if job_id:
+        database.update_job(job_id, {'steps': steps, 'done': 0})
+    for position, step in enumerate(steps):
+        if job_id:
+            database.update_job(job_id, {'steps.%d.status' % position: 'running'})
+        try:
+            if step['action'] == 'create':
+                database.create_index(model_name, step['keys'], step['options'], INDEX_BUILD_TIMEOUT)
+            else:
+                database.drop_index(model_name, step['name'])
+        except Exception as e:
+            # the remaining steps are not run, so no index is dropped whose replacement could not be built
+            if job_id:
+                database.update_job(job_id, {'steps.%d.status' % position: 'failed', 'steps.%d.error' % position: str(e)})
+            raise
+        if job_id:
+            database.update_job(job_id, {'steps.%d.status' % position: 'done', 'done': position + 1})
+    return steps
+
+
+def index_status(job):
+    # one line for the models page
+    if job is None:
+        return ''
+    steps = job.get('steps')
+    progress = ' %d/%d' % (job.get('done', 0), len(steps)) if steps else ''
+    if job['status'] == 'failed':
+        return 'failed%s: %s' % (progress, job.get('error', ''))
+    if job['status'] == 'done':
+        return 'up to date' if steps == [] else 'built%s' % progress
+    return job['status'] + progress
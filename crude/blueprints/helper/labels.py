@@ -0,0 +1,76 @@
+import os
+
+from blueprints.helper.common import new_storage, render_entries, display_projection
+from persistence.compound_ids import compound_id, split_reference
+from persistence.jobs import JobQueue
+
+LABEL_REFRESH_BATCH_SIZE = int(os.getenv('LABEL_REFRESH_BATCH_SIZE', '500'))
+
+label_jobs = JobQueue('label-refresh')
+
+# related fields with "cache_labels": true store the rendered label of every referenced entry in
+# entry['_labels'][field_name] = [{'id': compound_id, 'label': label, 'fields': {display fields}}]
+
+
+def cached_label_fields(model):
+    return [field for field in model['fields'] if field['type'] == 'related' and field.get('cache_labels')]
+
+
+def attach_related_labels(database, model, entries, dotted=False):
+    label_fields = cached_label_fields(model)
+    if len(label_fields) == 0:
+        return entries
+    ids_per_model = {}
+    for entry in entries:
+        for field in label_fields:
+            for reference in entry.get(field['name']) or []:
+                model_name, entry_id = split_reference(reference)
+                ids_per_model.setdefault(model_name, set()).add(entry_id)
+    labels = {}
+    for model_name, ids in ids_per_model.items():
+        labels |= render_labels(database, model_name, list(ids))
+    for entry in entries:
+        entry_labels = {}
+        for field in label_fields:
+            if field['name'] in entry:
+                compound_ids = [compound_id(reference) for reference in entry[field['name']] or []]
+                entry_labels[field['name']] = [labels[field_compound_id] for field_compound_id in compound_ids if field_compound_id in labels]
+        if dotted:
+            entry |= {'_labels.' + field_name: field_labels for field_name, field_labels in entry_labels.items()}
+        elif len(entry_labels) > 0:
+            entry['_labels'] = entry_labels
+    return entries
+
+
+def render_labels(database, model_name, entry_ids):
+    model = database.read_model(model_name)
+    if not model:
+        return {}
+    projection_fields, truncate = display_projection(model)
+    labels = {}
+    for entry, label in render_entries(model, database.find_all_ids(model_name, entry_ids, projection_fields, truncate)):
+        entry_compound_id = model_name + '/' + str(entry['_id'])
+        labels[entry_compound_id] = {'id': entry_compound_id, 'label': label, 'fields': {key: value for key, value in entry.items() if key != '_id'}}
+    return labels
+
+
+def cached_related_entries(entry, field_name):
+    # the related entries as far as they are known from the cached labels, keyed by compound id
+    labels = entry.get('_labels', {}).get(field_name, [])
+    return {label['id']: label['fields'] | {'_id': label['id'].split('/', 1)[1], '_label': label['label']} for label in labels}
+
+
+def schedule_label_refresh(database, model_name, entry_ids):
+    if not any(field.get('cache_labels') for referencing_model, field in database.find_references(model_name)):
+        return
+    for entry_id in entry_ids:
+        label_jobs.submit((model_name, str(entry_id)), refresh_labels, model_name, str(entry_id))
+
+
+def refresh_labels(model_name, entry_id):
+    database = new_storage()
+    labels = render_labels(database, model_name, [entry_id])
+    for referencing_model, field in database.find_references(model_name):
+        if field.get('cache_labels'):
+            for entry_compound_id, label in labels.items():
+                database.refresh_labels(referencing_model, field['name'], entry_compound_id, label, LABEL_REFRESH_BATCH_SIZE)
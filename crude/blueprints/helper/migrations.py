@@ -0,0 +1,141 @@
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from blueprints.helper.common import new_storage, field_types
+from blueprints.helper.fields import FieldPlan
+from persistence.jobs import JobQueue
+
+MIGRATION_JOB = 'migration'
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '500'))
+MIGRATION_OPS_PER_SECOND = float(os.getenv('MIGRATION_OPS_PER_SECOND', '1000'))
+MIGRATION_LEASE_SECONDS = 60
+
+migration_jobs = JobQueue('migrations')
+
+# migrations are tracked in the _jobs collection:
+# {'type': 'migration', 'model': name, 'fields': [{'name', 'from', 'to'}], 'required_fields': [...],
+#  'last_id': last converted _id, 'scanned': n, 'migrated': n, 'unconvertible': n, 'status': ..., 'lease_until': ...}
+
+
+def changed_fields(old_model, model):
+    # fields whose type or reference format changed
+    old_types = {field['name']: storage_type(field) for field in old_model['fields']} if old_model else {}
+    return [{'name': field['name'], 'from': old_types[field['name']], 'to': storage_type(field)} for field in model['fields'] if old_types.get(field['name'], storage_type(field)) != storage_type(field)]
+
+
+def storage_type(field):
+    if field['type'] == 'related' and field.get('ref_format'):
+        return 'related/' + field['ref_format']
+    return field['type']
+
+
+def schedule_migration(database, model_name, fields, required_fields):
+    job_id = database.create_job(MIGRATION_JOB, model_name, {'fields': fields, 'required_fields': required_fields, 'last_id': None, 'scanned': 0, 'migrated': 0, 'unconvertible': 0})
+    migration_jobs.submit(job_id, run_migration, job_id)
+    return job_id
+
+
+def resume_migrations(database):
+    for job in database.find_resumable_jobs(MIGRATION_JOB):
+        migration_jobs.submit(job['_id'], run_migration, job['_id'])
+
+
+def run_migration(job_id):
+    database = new_storage()
+    job = database.claim_job(job_id, '%s:%s' % (socket.gethostname(), os.getpid()), MIGRATION_LEASE_SECONDS)
+    if job is None:
+        # finished or running elsewhere
+        return
+    try:
+        error = migrate(database, job)
+    except Exception as e:
+        error = str(e)
+    database.update_job(job_id, {'status': 'failed' if error else 'done', 'error': error, 'finished': datetime.utcnow(), 'lease_until': None})
+    if error:
+        print('Migration of %s failed: %s' % (job['model'], error))
+
+
+def migrate(database, job):
+    # converts the changed fields batch by batch from where the job left off, then checks the required fields;
+    # returns an error message or None
+    model = database.read_model(job['model'])
+    if not model:
+        return 'Model %s does not exist anymore' % job['model']
+    field_names = [field['name'] for field in job['fields']]
+    converters = value_converters(model, field_names)
+    last_id, scanned, migrated, unconvertible = job['last_id'], job['scanned'], job['migrated'], job.get('unconvertible', 0)
+    while len(converters) > 0:
+        started = time.monotonic()
+        entries = database.read_batch(job['model'], last_id, list(converters.keys()), MIGRATION_BATCH_SIZE)
+        if len(entries) == 0:
+            break
+        changes = []
+        for entry in entries:
+            data, failed = converted_fields(converters, entry)
+            unconvertible += len(failed)
+            if len(data) > 0:
+                changes.append((entry, data))
+        migrated += database.update_entries(job['model'], changes)
+        scanned += len(entries)
+        last_id = entries[-1]['_id']
+        # the checkpoint also renews the lease
+        database.update_job(job['_id'], {'last_id': last_id, 'scanned': scanned, 'migrated': migrated, 'unconvertible': unconvertible, 'lease_until': datetime.utcnow() + timedelta(seconds=MIGRATION_LEASE_SECONDS)})
+        if MIGRATION_OPS_PER_SECOND > 0:
+            time.sleep(max(0.0, len(entries) / MIGRATION_OPS_PER_SECOND - (time.monotonic() - started)))
+    # strict validation would reject every later save of an entry that lacks a required field
+    missing = {field_name: count for field_name, count in database.count_missing(job['model'], job['required_fields']).items() if count > 0}
+    if len(missing) > 0:
+        return 'Required fields not enabled, entries without a value: %s' % ', '.join('%s (%d)' % item for item in missing.items())
+    database.set_required_fields(job['model'], job['required_fields'])
+    return None
+
+
+def value_converters(model, field_names):
+    sanitizers = dict(FieldPlan(model, field_types).sanitizers)
+    fields = {field['name']: field for field in model['fields']}
+    return {field_name: (fields[field_name], sanitizers[field_name]) for field_name in field_names if field_name in fields}
+
+
+def converted_fields(converters, entry):
+    # ({field: converted value}, [fields whose value cannot be converted]); such values are kept as they are
+    data = {}
+    failed = []
+    for field_name, (field, sanitizer) in converters.items():
+        if field_name not in entry or entry[field_name] is None:
+            continue
+        value = convert_value(field, sanitizer, entry[field_name])
+        if value is None and entry[field_name] not in ['', []]:
+            failed.append(field_name)
+            continue
+        # 1 == 1.0 == True, so the type has to match as well
+        if type(value) is not type(entry[field_name]) or value != entry[field_name]:
+            data[field_name] = value
+    return data, failed
+
+
+def convert_value(field, sanitizer, value):
+    # stored values run through the same conversion as form input
+    if field['type'] == 'related':
+        if isinstance(value, str) and '/' in value and not value.startswith('['):
+            value = [value]
+        return sanitizer(value)
+    if isinstance(value, list):
+        value = ', '.join(str(item) for item in value)
+    return sanitizer(value)
+
+
+def migration_status(job):
+    # one line for the models page
+    if job is None:
+        return ''
+    progress = ''
+    if job.get('fields'):
+        progress = ' (%d entries, %d converted' % (job.get('scanned', 0), job.get('migrated', 0))
+        if job.get('unconvertible'):
+            progress += ', %d values could not be converted and were kept' % job['unconvertible']
+        progress += ')'
+    if job['status'] == 'failed':
+        return 'failed%s: %s' % (progress, job.get('error', ''))
+    return job['status'] + progress
@@ -0,0 +1,24 @@
+import os
+
+from blueprints.helper.common import new_storage
+from persistence.compound_ids import stored_reference
+from persistence.jobs import JobQueue
+
+REFERENCE_CLEANUP_BATCH_SIZE = int(os.getenv('REFERENCE_CLEANUP_BATCH_SIZE', '500'))
+
+cleanup_jobs = JobQueue('reference-cleanup')
+
+
+def schedule_reference_cleanup(database, model_name, entry_ids):
+    # deleted entries are pulled out of the related fields that point at them, so no lookups for them are left behind
+    if len(database.find_references(model_name)) == 0:
+        return
+    for entry_id in entry_ids:
+        cleanup_jobs.submit((model_name, str(entry_id)), remove_references, model_name, str(entry_id))
+
+
+def remove_references(model_name, entry_id):
+    database = new_storage()
+    compound_id = model_name + '/' + entry_id
+    for referencing_model, field in database.find_references(model_name):
+        database.pull_references(referencing_model, field['name'], compound_id, stored_reference(field, compound_id), REFERENCE_CLEANUP_BATCH_SIZE)
@@ -1,13 +1,22 @@
 from flask import Blueprint, flash, url_for
+import click
 import json
+import os
 from flask import render_template
 
 from werkzeug.utils import redirect
 
-from blueprints.helper.common import get_input, VALID_FIELD_TYPES, db, clean_string
+from blueprints.helper.common import get_input, field_types, db, clean_string, invalidate_display_templates, is_api_call, json_response
+from blueprints.helper.migrations import MIGRATION_JOB, changed_fields, schedule_migration, migration_status, run_migration
+from blueprints.helper.index_builds import INDEX_BUILD_JOB, plan_index_build, schedule_index_build, build_indexes, index_status
+from persistence.indexes import describe_step
+from persistence.query_shapes import index_advice
 
 from blueprints.auth import auth_required
 
+ADVICE_MIN_COUNT = int(os.getenv('ADVICE_MIN_COUNT', '10'))
+ADVICE_MAX_EXAMINED_RATIO = float(os.getenv('ADVICE_MAX_EXAMINED_RATIO', '10'))
+
 model_blueprint = Blueprint('model', __name__, url_prefix='/models')
 
 
@@ -26,6 +35,7 @@ def edit(model_name=None):
 @auth_required
 def delete(model_name):
     db().delete_model(model_name)
+    invalidate_display_templates(model_name)
     flash('Model deleted: ' + model_name)
     return redirect(url_for('model.browse'))
 
@@ -46,59 +56,157 @@ def save():
         models = [model_input]
 
     for model in models:
-        model_name = clean_string(model['name'])
-        model['name'] = model_name
-        for field in model['fields']:
-            field['name'] = clean_string(field['name'])
-            if 'type' not in field:
-                field['type'] = 'text'
-            elif field['type'] not in VALID_FIELD_TYPES:
-                flash('Changed invalid field type (%s) to text: %s' % (field['type'], field['name']))
-                field['type'] = 'text'
-            elif field['type'] == 'related' and 'related_model' not in field:
-                flash('ERROR: Missing "related_model" for field: %s' % field['name'])
-                return redirect(url_for('model.browse'))
-        if 'display_fields' not in model:
-            model['display_fields'] = [field['name'] for field in model['fields']]
-        required_fields = [field['name'] for field in model['fields'] if 'required' in field and field['required']]
-        old_model = db().read_model(model_name)
-        indexes_changed = old_model and old_model.get('indexes', []) != model.get('indexes', [])
-        fts_indexes_changed = old_model and set(old_model.get('fts_index_fields', [])) != set(model.get('fts_index_fields', []))
-        db().save_model(model_name, model)
-        db().create_collection(model_name)
-        if indexes_changed or fts_indexes_changed:
-            flash('Indexes re-created for model: %s' % model_name)
-            db().drop_indexes(model_name)
-        else:
-            flash('Indexes unchanged for model: %s' % model_name)
-        if len(required_fields) > 0:
-            db().set_required_fields(model_name, required_fields)
-            flash('Required fields set for model: %s' % required_fields)
-        index_fields = []
-        text_index_fields = []
-        use_wildcard_text_index = False
-        if 'indexes' in model and indexes_changed:
-            for index in model['indexes']:
-                keys = index['keys'].items()
-                options = index['options'] if 'options' in index else {}
-                db().create_index(model_name, keys, options)
-                index_fields += index['keys'].keys()
-        if 'fts_index_fields' in model and fts_indexes_changed:
-            text_index_fields = model['fts_index_fields']
-            db().set_text_index(model_name, text_index_fields)
-        elif fts_indexes_changed:
-            use_wildcard_text_index = True
-            db().set_wildcard_text_index(model_name)
-        index_message = ' (idx: ' + ', '.join(index_fields) + ')' if len(index_fields) > 0 else ' (no index!)' if indexes_changed else ''
-        text_index_message = ' (wildcard fts index)' if use_wildcard_text_index else ' (fts-idx: ' + ', '.join(text_index_fields) + ')' if fts_indexes_changed else ''
-        flash('Model saved: ' + model_name + index_message + text_index_message)
+        if not save_model(model):
+            break
     return redirect(url_for('model.browse'))
 
 
+def save_model(model):
+    # validates and saves one model definition, creates its collection and starts building its indexes; flashes what happened
+    model_name = clean_string(model['name'])
+    model['name'] = model_name
+    for field in model['fields']:
+        field['name'] = clean_string(field['name'])
+        if 'type' not in field:
+            field['type'] = 'text'
+        elif not field_types.is_valid(field['type']):
+            flash('Changed invalid field type (%s) to text: %s' % (field['type'], field['name']))
+            field['type'] = 'text'
+        elif field['type'] == 'related' and 'related_model' not in field:
+            flash('ERROR: Missing "related_model" for field: %s' % field['name'])
+            return False
+    if 'display_fields' not in model:
+        model['display_fields'] = [field['name'] for field in model['fields']]
+    required_fields = [field['name'] for field in model['fields'] if 'required' in field and field['required']]
+    old_model = db().read_model(model_name)
+    old_required_fields = [field['name'] for field in old_model['fields'] if field.get('required')] if old_model else []
+    db().save_model(model_name, model)
+    invalidate_display_templates(model_name)
+    db().create_collection(model_name)
+    # existing entries are converted to changed field types in the background, required fields are enforced after that
+    fields = changed_fields(old_model, model)
+    required_changed = set(required_fields) != set(old_required_fields)
+    if len(fields) > 0 or required_changed:
+        schedule_migration(db(), model_name, fields, required_fields)
+    if len(fields) > 0:
+        flash('Migration started for model %s: %s' % (model_name, ', '.join('%s (%s -> %s)' % (field['name'], field['from'], field['to']) for field in fields)))
+    if required_changed and len(required_fields) > 0:
+        flash('Required fields will be set for model %s after a check of the existing entries: %s' % (model_name, required_fields))
+    # only the differences to the existing indexes are built, in the background
+    steps = plan_index_build(db(), model)
+    if len(steps) > 0:
+        schedule_index_build(db(), model_name)
+        flash('Index build started for model %s: %s' % (model_name, ', '.join(describe_step(step) for step in steps)))
+    else:
+        flash('Indexes unchanged for model: %s' % model_name)
+    if model.get('search_index') and old_model and (not old_model.get('search_index') or old_model.get('search_fields') != model.get('search_fields')):
+        flash('Search index enabled for model %s, run "flask model rebuild-search-index %s" to index existing entries' % (model_name, model_name))
+    flash('Model saved: ' + model_name)
+    return True
+
+
 @model_blueprint.route('/browse', methods=['GET'])
 @auth_required
 def browse():
     models = db().list_models()
-    render_context = {'models': models}
+    index_jobs = db().latest_jobs(INDEX_BUILD_JOB)
+    migration_jobs = db().latest_jobs(MIGRATION_JOB)
+    render_context = {
+        'models': models,
+        'index_status': {model_name: index_status(job) for model_name, job in index_jobs.items()},
+        'migration_status': {model_name: migration_status(job) for model_name, job in migration_jobs.items()}
+    }
     return render_template('model/browse.html', **render_context)
 
+
+@model_blueprint.route('/indexes/<model_name>', methods=['GET'])
+@auth_required
+def indexes(model_name):
+    model = db().read_model(model_name)
+    if not model:
+        return 'No page here', 404
+    output = {
+        'model_name': model_name,
+        'existing': db().list_indexes(model_name),
+        'pending_steps': plan_index_build(db(), model),
+        'build_progress': db().index_build_progress(model_name),
+        'jobs': db().read_jobs(INDEX_BUILD_JOB, model_name)
+    }
+    return json_response({'success': True, 'error': [], 'data': output})
+
+
+@model_blueprint.route('/migrations/<model_name>', methods=['GET'])
+@auth_required
+def migrations(model_name):
+    return json_response({'success': True, 'error': [], 'data': {'model_name': model_name, 'jobs': db().read_jobs(MIGRATION_JOB, model_name)}})
+
+
+@model_blueprint.route('/advice/<model_name>', methods=['GET'])
+@auth_required
+def advice(model_name):
+    model = db().read_model(model_name)
+    if not model:
+        return 'No page here', 404
+    shapes, suggested_indexes = get_index_advice(model)
+    if is_api_call():
+        # json_response keeps the order of the index keys
+        return json_response({'success': True, 'error': [], 'data': {'model_name': model_name, 'shapes': shapes, 'suggested_indexes': suggested_indexes}})
+    render_context = {'model_name': model_name, 'shapes': shapes, 'suggested_indexes': suggested_indexes, 'suggested_json': json.dumps(suggested_indexes, indent=4)}
+    return render_template('model/advice.html', **render_context)
+
+
+@model_blueprint.route('/advice/<model_name>/apply', methods=['POST'])
+@auth_required
+def apply_advice(model_name):
+    model = db().read_model(model_name)
+    if not model:
+        return 'No page here', 404
+    shapes, suggested_indexes = get_index_advice(model)
+    if len(suggested_indexes) == 0:
+        flash('No indexes to add for model: %s' % model_name)
+        return redirect(url_for('model.advice', model_name=model_name))
+    model.pop('_id', None)
+    model['indexes'] = model.get('indexes', []) + suggested_indexes
+    save_model(model)
+    return redirect(url_for('model.browse'))
+
+
+def get_index_advice(model):
+    # suggestions are checked against the declared and the existing indexes of the collection
+    shape_docs = db().read_query_shapes(model['name'])
+    known_indexes = {'indexes': model.get('indexes', []) + db().list_index_keys(model['name'])}
+    shapes, suggested_indexes = index_advice(known_indexes, shape_docs, ADVICE_MIN_COUNT, ADVICE_MAX_EXAMINED_RATIO)
+    for shape in shapes:
+        shape.pop('_id', None)
+    return shapes, suggested_indexes
+
+
+@model_blueprint.cli.command('rebuild-search-index')
+@click.argument('model_names', nargs=-1)
+def rebuild_search_index(model_names):
+    for model_name in model_names or db().get_all_model_names():
+        updated = db().rebuild_search_index(model_name)
+        print('Search index of %s: %s entries indexed' % (model_name, updated))
+
+
+@model_blueprint.cli.command('build-indexes')
+@click.argument('model_names', nargs=-1)
+def build_indexes_command(model_names):
+    for model_name in model_names or db().get_all_model_names():
+        steps = build_indexes(db(), model_name)
+        print('Indexes of %s: %s' % (model_name, ', '.join(describe_step(step) for step in steps) or 'unchanged'))
+
+
+@model_blueprint.cli.command('reload-field-types')
+def reload_field_types_command():
+    # every worker reloads its field types on its next request
+    generation = db().field_types_changed()
+    print('Field types generation: %s' % generation)
+
+
+@model_blueprint.cli.command('resume-migrations')
+def resume_migrations_command():
+    # runs the unfinished migrations in the foreground
+    for job in db().find_resumable_jobs(MIGRATION_JOB):
+        print('Migrating %s...' % job['model'])
+        run_migration(job['_id'])
@@ -0,0 +1,89 @@
+import os
+import time
+
+from flask import Blueprint, request, session, current_app, g
+
+from persistence.client import pool_stats
+from persistence.metrics import command_stats, Histogram, gauge, LATENCY_BUCKETS, COUNT_BUCKETS
+
+from blueprints.auth import auth_required
+from blueprints.helper.browsing import count_cache, search_cache
+from blueprints.helper.common import display_templates
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '500'))
+
+status_blueprint = Blueprint('status', __name__)
+
+request_durations = Histogram('http_request_duration_seconds', 'Duration of requests until the response is returned (without sending streamed bodies)', LATENCY_BUCKETS)
+request_commands = Histogram('http_request_mongo_commands', 'MongoDB commands per request (without those issued while a streamed body is sent)', COUNT_BUCKETS)
+request_command_durations = Histogram('http_request_mongo_seconds', 'Time spent in MongoDB commands per request (without those issued while a streamed body is sent)', LATENCY_BUCKETS)
+
+
+@status_blueprint.before_app_request
+def start_request_trace():
+    g.request_started = time.perf_counter()
+    command_stats.start_trace()
+
+
+@status_blueprint.after_app_request
+def record_request_trace(response):
+    # streamed responses are measured until their first byte, commands issued while streaming are not counted
+    if 'request_started' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_started
+    trace = command_stats.stop_trace()
+    mongo_seconds = sum(command[2] for command in trace)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_durations.observe({'route': route, 'method': request.method, 'status': str(response.status_code)}, seconds)
+    request_commands.observe({'route': route}, len(trace))
+    request_command_durations.observe({'route': route}, mongo_seconds)
+    response.headers['X-Mongo-Commands'] = str(len(trace))
+    response.headers['X-Mongo-Time-Ms'] = '%.1f' % (mongo_seconds * 1000)
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        print('Slow request (%.1f ms, %d MongoDB commands in %.1f ms): %s %s' % (seconds * 1000, len(trace), mongo_seconds * 1000, request.method, request.full_path))
+        for command_name, collection, command_seconds in trace:
+            print('    %.1f ms %s %s' % (command_seconds * 1000, command_name, collection))
+    return response
+
+
+@status_blueprint.route('/status/pool', methods=['GET'])
+@auth_required
+def pool():
+    return pool_stats.as_dict()
+
+
+@status_blueprint.route('/status/caches', methods=['GET'])
+@auth_required
+def caches():
+    return {'search': search_cache.stats(), 'count': count_cache.stats()}
+
+
+@status_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    # scrapers authenticate with "Authorization: Bearer <METRICS_TOKEN>", browsers with their session
+    authorized = 'wallet' in session and session['wallet']
+    if METRICS_TOKEN and request.headers.get('Authorization') == 'Bearer ' + METRICS_TOKEN:
+        authorized = True
+    if not authorized:
+        return 'Unauthorized', 401
+    # every worker process keeps its own metrics, the worker label keeps their series (and rate()) apart
+    worker = {'worker': str(os.getpid())}
+    lines = request_durations.render(worker) + request_commands.render(worker) + request_command_durations.render(worker) + command_stats.durations.render(worker)
+    caches = {'search': search_cache.stats(), 'count': count_cache.stats()}
+    lines += gauge('cache_hits_total', 'Cache hits', [({'cache': name}, stats['hits']) for name, stats in caches.items()], 'counter', worker)
+    lines += gauge('cache_misses_total', 'Cache misses', [({'cache': name}, stats['misses']) for name, stats in caches.items()], 'counter', worker)
+    lines += gauge('cache_hit_ratio', 'Cache hits per lookup', [({'cache': name}, hit_ratio(stats)) for name, stats in caches.items()], common_labels=worker)
+    lines += gauge('display_templates_cached', 'Compiled display templates', [({}, len(display_templates))], common_labels=worker)
+    pool_values = pool_stats.as_dict()
+    lines += gauge('mongo_pool_connections_open', 'Open MongoDB connections', [({}, pool_values['connections_open'])], common_labels=worker)
+    lines += gauge('mongo_pool_checked_out', 'MongoDB connections in use', [({}, pool_values['checked_out'])], common_labels=worker)
+    lines += gauge('mongo_pool_checkouts_total', 'MongoDB connection checkouts', [({}, pool_values['checkouts'])], 'counter', worker)
+    lines += gauge('mongo_pool_checkout_failures_total', 'Failed MongoDB connection checkouts', [({}, pool_values['checkout_failures'])], 'counter', worker)
+    lines += gauge('mongo_pool_wait_seconds_total', 'Time spent waiting for MongoDB connections', [({}, pool_values['wait_time_total_ms'] / 1000)], 'counter', worker)
+    return current_app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def hit_ratio(stats):
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
@@ -1,4 +1,7 @@
 class Textarea:
+    # list views show at most 60 characters, so longer values are cut on the server
+    LIST_MAX_LENGTH = 60
+
     @staticmethod
     def input_to_json_value(field_definition, input_data):
         input_value = input_data[field_definition['name']]
@@ -10,3 +13,4 @@ class Textarea:
         max_length -= 3
         if len(json_value) > max_length:
             return json_value[0:max_length] + '(…)'
+        return json_value
@@ -0,0 +1,111 @@
+import asyncio
+
+from persistence.storage import JOBS_COLLECTION, Storage, keyset_query, keyset_page, relation_groups_pipeline, relation_groups, prefix_search_expression, regex_search_expression
+from persistence.keyset import keyset_sort
+
+
+def in_thread(method_name):
+    async def method(self, *args, **kwargs):
+        return await asyncio.to_thread(getattr(self.storage, method_name), *args, **kwargs)
+    method.__name__ = method_name
+    return method
+
+
+def refused(method_name):
+    def method(self, *args, **kwargs):
+        raise NotImplementedError('%s is not available on AsyncStorage, call it on AsyncStorage.storage in a thread' % method_name)
+    method.__name__ = method_name
+    return method
+
+
+class AsyncStorage(Storage):
+    # the Storage of the ASGI mode: queries go through motor, so read() and the counts return awaitables and the
+    # query methods return motor cursors (async for / to_list); everything else, including the model cache and the
+    # generations (which poll _meta), runs the synchronous Storage in a thread and is awaited as well; inherited
+    # methods that would block or compare motor futures are refused
+    def __init__(self, async_client, storage):
+        super().__init__(storage.client, storage.generations, storage.model_cache, storage.query_shapes)
+        self.storage = storage
+        self.async_client = async_client
+        self.db = async_client.crude
+        self.models = self.db['_models']
+        self.meta = self.db['_meta']
+        self.jobs = self.db[JOBS_COLLECTION]
+
+    def record_query(self, model_name, filter_expression, sort_list=None, limit=0):
+        # only counts in memory, the explain jobs run in a background thread with the synchronous client
+        self.storage.record_query(model_name, filter_expression, sort_list, limit)
+
+    async def find_relation_groups(self, related_model_name, references, limit=10, projection_fields=None, truncate=None):
+        collection = self.db[related_model_name]
+        pipeline = relation_groups_pipeline(references, limit, projection_fields, truncate)
+        results = await collection.aggregate(pipeline).to_list(1)
+        return relation_groups(references, results[0])
+
+    async def browse_keyset(self, model_name, filter_expression, sort_doc, keys=None, forward=True, items_per_page=10, projection_fields=None, truncate=None):
+        sort_list = keyset_sort(sort_doc)
+        self.record_query(model_name, filter_expression, sort_list, items_per_page + 1)
+        filter_expression, query_sort = keyset_query(filter_expression, sort_list, keys, forward)
+        entries = await self.query(model_name, filter_expression, query_sort, 0, items_per_page + 1, projection_fields, truncate).to_list(None)
+        return keyset_page(entries, items_per_page, forward)
+
+    # the search functions are awaited for the cursor, the search index of the model comes from the model cache
+    async def full_text_search(self, model_name, search_fields, projection_fields, search_term, limit):
+        return super().full_text_search(model_name, search_fields, projection_fields, search_term, limit)
+
+    async def prefix_search(self, model_name, search_fields, projection_fields, search_term, limit):
+        search_index = await self.search_index_fields(model_name) is not None
+        return self.search_cursor(model_name, prefix_search_expression(search_fields, search_term, search_index), projection_fields, limit)
+
+    async def regex_search(self, model_name, search_fields, projection_fields, search_term, limit):
+        search_index = await self.search_index_fields(model_name) is not None
+        return self.search_cursor(model_name, regex_search_expression(search_fields, search_term, search_index), projection_fields, limit)
+
+    cached_models = in_thread('cached_models')
+    read_model = in_thread('read_model')
+    peek_model = in_thread('peek_model')
+    read_models = in_thread('read_models')
+    list_models = in_thread('list_models')
+    get_all_model_names = in_thread('get_all_model_names')
+    get_search_and_display_fields = in_thread('get_search_and_display_fields')
+    search_index_fields = in_thread('search_index_fields')
+    find_references = in_thread('find_references')
+    collection_generation = in_thread('collection_generation')
+    models_generation = in_thread('models_generation')
+    collection_changed = in_thread('collection_changed')
+    field_types_generation = in_thread('field_types_generation')
+    field_types_changed = in_thread('field_types_changed')
+    matches_filter = in_thread('matches_filter')
+    create = in_thread('create')
+    insert_many = in_thread('insert_many')
+    bulk_write = in_thread('bulk_write')
+    refresh_search_tokens = in_thread('refresh_search_tokens')
+    update = in_thread('update')
+    save = in_thread('save')
+    delete = in_thread('delete')
+    refresh_labels = in_thread('refresh_labels')
+    pull_references = in_thread('pull_references')
+    read_query_shapes = in_thread('read_query_shapes')
+    list_index_keys = in_thread('list_index_keys')
+    save_model = in_thread('save_model')
+    delete_model = in_thread('delete_model')
+    rebuild_search_index = in_thread('rebuild_search_index')
+    create_search_index = in_thread('create_search_index')
+    list_indexes = in_thread('list_indexes')
+    create_index = in_thread('create_index')
+    drop_index = in_thread('drop_index')
+    index_build_progress = in_thread('index_build_progress')
+    create_job = in_thread('create_job')
+    update_job = in_thread('update_job')
+    read_jobs = in_thread('read_jobs')
+    latest_jobs = in_thread('latest_jobs')
+    claim_job = in_thread('claim_job')
+    find_resumable_jobs = in_thread('find_resumable_jobs')
+    read_batch = in_thread('read_batch')
+    update_entries = in_thread('update_entries')
+    count_missing = in_thread('count_missing')
+    create_collection = in_thread('create_collection')
+    set_required_fields = in_thread('set_required_fields')
+    # synchronous by nature: search tokens are added by the write methods, the change hub runs in a thread
+    with_search_tokens = refused('with_search_tokens')
+    watch_changes = refused('watch_changes')
@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from bson.json_util import dumps, loads
+
+
+class TTLCache:
+    def __init__(self, ttl, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.items), 'max_size': self.max_size}
+
+
+class LRUCache:
+    # keys must carry everything the value depends on (e.g. a generation), entries are only evicted by size
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.items), 'max_size': self.max_size}
+
+
+class UwsgiCache:
+    # shared by all workers of a uWSGI instance, e.g. --cache2 name=search,items=4096,purge_lru=1
+    # the counters are per worker
+    def __init__(self, cache_name, expires=0):
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.cache_name = cache_name
+        self.expires = expires
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.uwsgi.cache_get(json.dumps(key), self.cache_name)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return loads(value)
+
+    def set(self, key, value):
+        self.uwsgi.cache_update(json.dumps(key), dumps(value).encode(), self.expires, self.cache_name)
+
+    def clear(self):
+        self.uwsgi.cache_clear(self.cache_name)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cache_name': self.cache_name}
+
+
+def new_cache(max_size, uwsgi_cache_name=None):
+    if uwsgi_cache_name:
+        try:
+            return UwsgiCache(uwsgi_cache_name)
+        except ImportError:
+            print('uWSGI is not available, using a local cache instead of "%s"' % uwsgi_cache_name)
+    return LRUCache(max_size)
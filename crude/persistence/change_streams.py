@@ -0,0 +1,235 @@
+import collections
+import os
+import queue
+import threading
+import time
+
+from bson.json_util import dumps
+from pymongo.errors import PyMongoError
+
+ENTRY_OPERATIONS = ['insert', 'update', 'replace', 'delete']
+
+# events: {'id': resume token data or None, 'type': operation or 'reset', 'model': model name or None (all models),
+#          '_id': entry id or None, 'entry': the entry after the change or None}
+# a 'reset' event ends a subscription whose client has to reload (dropped or renamed collection, lost history,
+# a subscriber that could not keep up, a failed change stream)
+
+
+def change_event(change):
+    operation = change['operationType']
+    model_name = change.get('ns', {}).get('coll')
+    if operation not in ENTRY_OPERATIONS:
+        return reset_event('%s %s' % (operation, model_name or 'database'), model_name, change['_id']['_data'])
+    return {'id': change['_id']['_data'], 'type': operation, 'model': model_name, '_id': change['documentKey']['_id'], 'entry': change.get('fullDocument')}
+
+
+def reset_event(reason, model_name=None, event_id=None):
+    return {'id': event_id, 'type': 'reset', 'model': model_name, '_id': None, 'entry': None, 'reason': reason}
+
+
+class Subscriber:
+    # one client connection following a model, optionally a single entry of it or the entries matching a filter;
+    # the hub thread calls deliver(), the connection waits in next_event()
+    def __init__(self, model_name, entry_id=None, filter_expression=None):
+        self.model_name = model_name
+        self.entry_id = entry_id
+        self.filter_expression = filter_expression or None
+        self.filter_key = (model_name, dumps(filter_expression, sort_keys=True)) if filter_expression else None
+        self.events = queue.Queue()
+        self.closed = False
+
+    def deliver(self, event):
+        self.events.put(event)
+
+    def backlog(self):
+        return self.events.qsize()
+
+    def next_event(self, timeout):
+        # None when nothing happened for timeout seconds
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeHub:
+    # a single change stream per worker process, shared by all subscribers and only open while there are any;
+    # the last buffer_size events are kept, so a client that reconnects with the id of the last event it got
+    # (Last-Event-ID, the resume token of the change) is sent what it missed; older events, or those of another
+    # worker, are read from a change stream resumed after that token before the client joins the shared one
+    def __init__(self, new_storage, buffer_size=1000, max_backlog=1000, max_await_time_ms=1000):
+        self.new_storage = new_storage
+        self.buffer_size = buffer_size
+        self.max_backlog = max_backlog
+        self.max_await_time_ms = max_await_time_ms
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.subscribers = []
+        self.resume_token = None
+        self.database = None
+        self.running = False
+        self.pid = None
+        # reentrant, a failed delivery unsubscribes while the lock is held
+        self.lock = threading.RLock()
+
+    def subscribe(self, subscriber, last_event_id=None):
+        with self.lock:
+            if self.pid != os.getpid():
+                # a hub inherited through fork() has no thread in this process
+                self.buffer = collections.deque(maxlen=self.buffer_size)
+                self.subscribers = []
+                self.resume_token = None
+                self.running = False
+                self.database = self.new_storage()
+                self.pid = os.getpid()
+            if last_event_id:
+                missed = self.events_after(last_event_id)
+                if missed is None:
+                    threading.Thread(target=self.catch_up, args=(subscriber, last_event_id), name='change-stream-catch-up', daemon=True).start()
+                    return
+                # replayed under the lock, so no newer event can overtake the missed ones
+                matched = {}
+                for event in missed:
+                    if self.offer(subscriber, event, matched) and event['type'] == 'reset':
+                        return
+            self.join(subscriber)
+
+    def join(self, subscriber, resume_token=None):
+        # with the lock held; a stopped stream starts after resume_token, or now
+        if subscriber.closed:
+            return
+        self.subscribers.append(subscriber)
+        if not self.running:
+            self.running = True
+            self.resume_token = resume_token
+            threading.Thread(target=self.run, name='change-stream', daemon=True).start()
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscriber.closed = True
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def events_after(self, event_id):
+        ids = [event['id'] for event in self.buffer]
+        if event_id not in ids:
+            return None
+        return list(self.buffer)[ids.index(event_id) + 1:]
+
+    def catch_up(self, subscriber, last_event_id):
+        # the events after last_event_id from a change stream of its own, until it reaches the buffered events
+        # of the shared stream or the present; resume tokens sort in the order of the changes
+        try:
+            with self.database.watch_changes({'_data': last_event_id}, self.max_await_time_ms) as stream:
+                while stream.alive and not subscriber.closed:
+                    change = stream.try_next()
+                    with self.lock:
+                        if change is None or (len(self.buffer) > 0 and change['_id']['_data'] >= self.buffer[0]['id']):
+                            matched = {}
+                            for event in self.buffer:
+                                if event['id'] > last_event_id and self.offer(subscriber, event, matched) and event['type'] == 'reset':
+                                    return
+                            self.join(subscriber, {'_data': last_event_id})
+                            return
+                    event = change_event(change)
+                    if self.offer(subscriber, event, {}) and event['type'] == 'reset':
+                        return
+                    last_event_id = event['id']
+            if not subscriber.closed:
+                self.deliver(subscriber, reset_event('Change stream invalidated', subscriber.model_name))
+        except Exception as e:
+            # MongoDB does not know the token (anymore)
+            print('Cannot resume after %s: %s' % (last_event_id, str(e)))
+            self.deliver(subscriber, reset_event('Cannot resume after event %s: %s' % (last_event_id, str(e)), subscriber.model_name))
+
+    def run(self):
+        while True:
+            try:
+                with self.database.watch_changes(self.resume_token, self.max_await_time_ms) as stream:
+                    while stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            self.publish(change_event(change))
+                        self.resume_token = stream.resume_token
+                        if self.stop_if_idle():
+                            return
+                # invalidated: the database was dropped or renamed, its events cannot be resumed
+                self.reset_all('Change stream invalidated')
+            except Exception as e:
+                # the driver resumes after network errors by itself, this is a standalone server (no change
+                # streams), a resume token that fell off the oplog, an unreachable server or a bug; the thread
+                # must not die with running still set
+                print('Change stream failed: %s' % str(e))
+                self.reset_all('Change stream failed: %s' % str(e))
+            if self.stop_if_idle():
+                return
+            time.sleep(1)
+
+    def stop_if_idle(self):
+        # events of a stopped stream are missed, so the buffer starts over with the next subscriber
+        with self.lock:
+            if len(self.subscribers) > 0:
+                return False
+            self.buffer.clear()
+            self.resume_token = None
+            self.running = False
+            return True
+
+    def reset_all(self, reason):
+        with self.lock:
+            subscribers = self.subscribers
+            self.subscribers = []
+            self.buffer.clear()
+            self.resume_token = None
+        for subscriber in subscribers:
+            self.deliver(subscriber, reset_event(reason, subscriber.model_name))
+
+    def publish(self, event):
+        with self.lock:
+            self.buffer.append(event)
+            subscribers = list(self.subscribers)
+        # subscribers with the same filter share one check per event
+        matched = {}
+        for subscriber in subscribers:
+            if subscriber.backlog() >= self.max_backlog:
+                self.unsubscribe(subscriber)
+                self.deliver(subscriber, reset_event('Too many undelivered events', subscriber.model_name))
+                continue
+            if self.offer(subscriber, event, matched) and event['type'] == 'reset':
+                self.unsubscribe(subscriber)
+
+    def offer(self, subscriber, event, matched):
+        # delivers the event if the subscriber follows it, returns whether it did
+        if event['model'] not in [None, subscriber.model_name]:
+            return False
+        if event['type'] == 'reset' or (subscriber.filter_expression is None and subscriber.entry_id is None):
+            return self.deliver(subscriber, event)
+        if subscriber.entry_id is not None and event['_id'] != subscriber.entry_id:
+            return False
+        if subscriber.filter_expression is None or event['type'] == 'delete':
+            return self.deliver(subscriber, event)
+        if subscriber.filter_key not in matched:
+            matched[subscriber.filter_key] = self.matches(event, subscriber.filter_expression)
+        if matched[subscriber.filter_key]:
+            return self.deliver(subscriber, event)
+        if event['type'] == 'insert':
+            return False
+        # the entry may have matched before, the client drops it if it shows it
+        return self.deliver(subscriber, event | {'type': 'unmatched', 'entry': None})
+
+    def deliver(self, subscriber, event):
+        # a subscriber that cannot take events anymore (e.g. its event loop is closed) is dropped
+        try:
+            subscriber.deliver(event)
+            return True
+        except Exception as e:
+            print('Dropping change stream subscriber: %s' % str(e))
+            self.unsubscribe(subscriber)
+            return False
+
+    def matches(self, event, filter_expression):
+        # the filter is checked against the entry as it is now, with a point query on its _id
+        try:
+            return self.database.matches_filter(event['model'], event['_id'], filter_expression)
+        except PyMongoError as e:
+            print('Filter check on %s failed: %s' % (event['model'], str(e)))
+            return False
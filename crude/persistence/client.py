@@ -0,0 +1,168 @@
+import atexit
+import os
+import threading
+import time
+
+from pymongo import MongoClient, monitoring
+
+from persistence.metrics import command_stats
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connections_open = 0
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.wait_time_total = 0.0
+            self.wait_time_max = 0.0
+            self.pools_cleared = 0
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'connections_open': self.connections_open,
+                'connections_created': self.connections_created,
+                'connections_closed': self.connections_closed,
+                'checked_out': self.checked_out,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_time_total_ms': round(self.wait_time_total * 1000, 3),
+                'wait_time_avg_ms': round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'wait_time_max_ms': round(self.wait_time_max * 1000, 3),
+                'pools_cleared': self.pools_cleared,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pools_cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.connections_created += 1
+            self.connections_open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.connections_closed += 1
+            self.connections_open -= 1
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self.record_wait()
+        with self.lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        waited = self.record_wait()
+        with self.lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def record_wait(self):
+        started = getattr(self.local, 'started', None)
+        self.local.started = None
+        return time.perf_counter() - started if started else 0.0
+
+
+pool_stats = PoolStats()
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_async_client = None
+_async_client_pid = None
+
+
+def get_client(connection_string, **options):
+    # one pooled client per process; a client inherited through fork() is never reused
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            print('Connecting to MongoDB (pid %s)...' % os.getpid())
+            pool_stats.reset()
+            _client = MongoClient(connection_string, event_listeners=[pool_stats, command_stats], **options)
+            _client_pid = os.getpid()
+    return _client
+
+
+def get_async_client(connection_string, **options):
+    # the motor client of the ASGI mode, created inside the running event loop of this process
+    global _async_client, _async_client_pid
+    if AsyncIOMotorClient is None:
+        raise RuntimeError('The ASGI mode needs motor: pip install motor')
+    if _async_client is None or _async_client_pid != os.getpid():
+        print('Connecting to MongoDB with motor (pid %s)...' % os.getpid())
+        _async_client = AsyncIOMotorClient(connection_string, event_listeners=[command_stats], **options)
+        _async_client_pid = os.getpid()
+    return _async_client
+
+
+def close_client():
+    global _client, _client_pid, _async_client, _async_client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+    if _async_client is not None and _async_client_pid == os.getpid():
+        _async_client.close()
+    _async_client = None
+    _async_client_pid = None
+
+
+def _forget_client_after_fork():
+    # the parent's sockets and monitor threads are not usable in the child, and closing them would
+    # disturb the parent, so the child just drops its reference and connects lazily on first use
+    global _client, _client_pid, _client_lock, _async_client, _async_client_pid
+    _client = None
+    _client_pid = None
+    _async_client = None
+    _async_client_pid = None
+    _client_lock = threading.Lock()
+    pool_stats.reset()
+
+
+os.register_at_fork(after_in_child=_forget_client_after_fork)
+atexit.register(close_client)
+
+try:
+    import uwsgi
+    uwsgi.atexit = close_client
+except ImportError:
+    pass
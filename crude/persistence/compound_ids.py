@@ -0,0 +1,57 @@
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+DBREF_FORMAT = 'dbref'
+
+# related fields keep references as compound id strings ("model/hexid"), or with "ref_format": "dbref" as
+# DBRef(model, ObjectId) (smaller, no string parsing, _ids in the index); everything outside the database
+# (JSON API, exports, tagify inputs, labels) only ever sees compound id strings
+
+
+def compound_id(reference):
+    if isinstance(reference, DBRef):
+        return reference.collection + '/' + str(reference.id)
+    return str(reference)
+
+
+def split_reference(reference):
+    # (model name, entry id string)
+    if isinstance(reference, DBRef):
+        return reference.collection, str(reference.id)
+    model_name, entry_id = reference.split('/', 1)
+    return model_name, entry_id
+
+
+def stored_reference(field, reference):
+    # the value that is written to (and matched in) the database for a reference in this related field
+    if field.get('ref_format') != DBREF_FORMAT:
+        return compound_id(reference)
+    model_name, entry_id = split_reference(reference)
+    return DBRef(model_name, ObjectId(entry_id))
+
+
+def field_references(model, field_names, reference):
+    # {field name: stored reference} for a reference in each of the given related fields of model
+    fields = {field['name']: field for field in model['fields']}
+    return {field_name: stored_reference(fields.get(field_name, {}), reference) for field_name in field_names}
+
+
+def dbref_fields(model):
+    return [field['name'] for field in model['fields'] if field['type'] == 'related' and field.get('ref_format') == DBREF_FORMAT]
+
+
+def with_compound_ids(field_names, entry):
+    for field_name in field_names:
+        if isinstance(entry.get(field_name), list):
+            entry[field_name] = [compound_id(reference) for reference in entry[field_name]]
+    return entry
+
+
+def plain_references(model, entries):
+    # entries (list, cursor or generator) with their DBRefs turned into compound ids again
+    field_names = dbref_fields(model) if model else []
+    if len(field_names) == 0:
+        return entries
+    if isinstance(entries, list):
+        return [with_compound_ids(field_names, entry) for entry in entries]
+    return (with_compound_ids(field_names, entry) for entry in entries)
@@ -0,0 +1,38 @@
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+
+class Generations:
+    # generation counters live in the _meta collection, one document per key;
+    # workers poll all of them with one query at most every poll_interval seconds
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.values = {}
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def current(self, meta_collection, key):
+        if time.monotonic() - self.checked_at >= self.poll_interval:
+            self.poll(meta_collection)
+        return self.values.get(key, 0)
+
+    def poll(self, meta_collection):
+        with self.lock:
+            if time.monotonic() - self.checked_at < self.poll_interval:
+                return
+            values = {doc['_id']: doc.get('generation', 0) for doc in meta_collection.find({}, {'generation': 1})}
+            self.values = values
+            self.checked_at = time.monotonic()
+
+    def bump(self, meta_collection, key):
+        doc = meta_collection.find_one_and_update(
+            {'_id': key},
+            {'$inc': {'generation': 1}},
+            projection={'generation': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.values = self.values | {key: doc['generation']}
+        return doc['generation']
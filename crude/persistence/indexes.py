@@ -0,0 +1,111 @@
+from persistence.search_index import SEARCH_TOKENS_FIELD
+from persistence.storage import get_search_fields
+
+COMPARED_OPTIONS = ['unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds']
+
+# index specs: {'name': str or None, 'keys': [[field, direction], ...], 'options': {...}, 'text': [field, ...] or None}
+# keys are kept as lists of pairs, they contain dots and '$**' and are stored in the _jobs collection
+
+
+def declared_indexes(model):
+    # the indexes a model asks for: its "indexes", a multikey index per related field (for reverse lookups and the
+    # cleanup of deleted references) unless an index starts with it already, one text index for full-text search (on
+    # "fts_index_fields" or the search fields; a wildcard text index would also cover the search tokens and cached
+    # labels) and the search token index of "search_index" models
+    specs = []
+    for index in model.get('indexes', []):
+        options = dict(index.get('options', {}))
+        specs.append({'name': options.pop('name', None), 'keys': [[field, direction] for field, direction in index['keys'].items()], 'options': options, 'text': None})
+    leading_fields = [spec['keys'][0][0] for spec in specs if len(spec['keys']) > 0 and not spec['options'].get('partialFilterExpression')]
+    for field in model['fields']:
+        if field['type'] == 'related' and field['name'] not in leading_fields:
+            specs.append({'name': None, 'keys': [[field['name'], 1]], 'options': {}, 'text': None})
+    text_fields = model.get('fts_index_fields') or get_search_fields(model)
+    if len(text_fields) > 0:
+        specs.append({'name': None, 'keys': [[field, 'text'] for field in text_fields], 'options': {}, 'text': sorted(text_fields)})
+    if model.get('search_index'):
+        specs.append({'name': None, 'keys': [[SEARCH_TOKENS_FIELD, 1]], 'options': {}, 'text': None})
+    return specs
+
+
+def existing_indexes(index_docs):
+    # index_docs: the documents of list_indexes(); the _id index is never touched
+    specs = []
+    for index_doc in index_docs:
+        if index_doc['name'] == '_id_':
+            continue
+        keys = [[field, direction] for field, direction in index_doc['key'].items()]
+        text_keys = [field for field, direction in keys if direction == 'text']
+        text = sorted(index_doc['weights'].keys()) if 'weights' in index_doc else sorted(text_keys) if text_keys else None
+        options = {option: index_doc[option] for option in COMPARED_OPTIONS if option in index_doc}
+        specs.append({'name': index_doc['name'], 'keys': keys, 'options': options, 'text': text})
+    return specs
+
+
+def index_identity(spec):
+    if spec['text'] is not None:
+        return 'text', tuple(spec['text'])
+    keys = tuple((field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in spec['keys'])
+    options = tuple((option, spec['options'][option]) for option in COMPARED_OPTIONS if spec['options'].get(option) not in [None, False])
+    return keys, repr(options)
+
+
+def matches(spec, existing):
+    return index_identity(spec) == index_identity(existing) and spec['name'] in [None, existing['name']]
+
+
+def default_index_name(spec):
+    return '_'.join('%s_%s' % (field, direction) for field, direction in spec['keys'])
+
+
+def clashes(spec, existing):
+    # MongoDB allows a single text index per collection and one index per name and per key pattern
+    if spec['text'] is not None or existing['text'] is not None:
+        return spec['text'] is not None and existing['text'] is not None
+    return (spec['name'] or default_index_name(spec)) == existing['name'] or index_identity(spec | {'options': {}}) == index_identity(existing | {'options': {}})
+
+
+def index_plan(declared, existing):
+    # the steps that turn the existing into the declared indexes: new indexes are created before obsolete ones are
+    # dropped, so queries keep an index while the new one is built; only an index that clashes with its replacement
+    # is dropped first
+    obsolete = list(existing)
+    creates = []
+    for spec in declared:
+        match = next((index for index in obsolete if matches(spec, index)), None)
+        if match is None:
+            creates.append(spec)
+        else:
+            obsolete.remove(match)
+    steps = []
+    replacements = []
+    for spec in creates:
+        clashing = [index for index in obsolete if clashes(spec, index)]
+        if len(clashing) == 0:
+            steps.append(create_step(spec))
+        else:
+            replacements.append((spec, clashing))
+    dropped = []
+    for spec, clashing in replacements:
+        for index in clashing:
+            if index not in dropped:
+                steps.append(drop_step(index))
+                dropped.append(index)
+        steps.append(create_step(spec))
+    for index in obsolete:
+        if index not in dropped:
+            steps.append(drop_step(index))
+    return steps
+
+
+def create_step(spec):
+    options = spec['options'] | ({'name': spec['name']} if spec['name'] else {})
+    return {'action': 'create', 'name': spec['name'] or default_index_name(spec), 'keys': spec['keys'], 'options': options, 'status': 'pending'}
+
+
+def drop_step(spec):
+    return {'action': 'drop', 'name': spec['name'], 'keys': spec['keys'], 'options': spec['options'], 'status': 'pending'}
+
+
+def describe_step(step):
+    return '%s %s' % (step['action'], step['name'])
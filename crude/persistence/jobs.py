@@ -0,0 +1,43 @@
+import os
+import queue
+import threading
+
+
+class JobQueue:
+    # a daemon thread per worker process that runs submitted functions one after another;
+    # jobs with the same key are only queued once until they have started
+    def __init__(self, name):
+        self.name = name
+        self.jobs = None
+        self.pending = set()
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        self.ensure_worker()
+        with self.lock:
+            if key is not None and key in self.pending:
+                return False
+            self.pending.add(key)
+        self.jobs.put((key, function, args))
+        return True
+
+    def ensure_worker(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.jobs = queue.Queue()
+                self.pending = set()
+                threading.Thread(target=self.run, args=(self.jobs,), name=self.name, daemon=True).start()
+                self.pid = os.getpid()
+
+    def run(self, jobs):
+        while True:
+            key, function, args = jobs.get()
+            with self.lock:
+                self.pending.discard(key)
+            try:
+                function(*args)
+            except Exception as e:
+                print('Job %s %s failed: %s' % (self.name, key, str(e)))
@@ -0,0 +1,60 @@
+import base64
+import hashlib
+
+from bson.json_util import dumps, loads
+
+
+def keyset_sort(sort_doc):
+    # _id is always the last key, so every position in the sort order is unique
+    sort_list = [(field, int(direction)) for field, direction in sort_doc.items() if field != '_id']
+    id_direction = int(sort_doc.get('_id', sort_list[-1][1] if len(sort_list) > 0 else 1))
+    return sort_list + [('_id', id_direction)]
+
+
+def sort_signature(sort_list):
+    return hashlib.sha1(dumps(sort_list).encode('utf-8')).hexdigest()[:8]
+
+
+def encode_token(sort_list, entry):
+    keys = [get_path(entry, field) for field, direction in sort_list]
+    payload = dumps({'s': sort_signature(sort_list), 'k': keys})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(sort_list, token):
+    # a token that does not belong to the current sort order starts over at the first page
+    try:
+        payload = loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except ValueError:
+        return None
+    if payload.get('s') != sort_signature(sort_list) or len(payload.get('k', [])) != len(sort_list):
+        return None
+    return payload['k']
+
+
+def keyset_filter(sort_list, keys, forward=True):
+    # (a, b, _id) > (x, y, z)  <=>  a > x or (a == x and b > y) or (a == x and b == y and _id > z)
+    clauses = []
+    for position, (field, direction) in enumerate(sort_list):
+        after = compare_after(keys[position], direction if forward else -direction)
+        if after is not None:
+            clause = {sort_list[i][0]: keys[i] for i in range(position)}
+            clause[field] = after
+            clauses.append(clause)
+    return {'$or': clauses} if len(clauses) > 0 else {'_id': {'$exists': False}}
+
+
+def compare_after(value, direction):
+    # null and missing values sort before everything else, so they come last in descending order
+    if value is None:
+        return {'$ne': None} if direction > 0 else None
+    return {'$gt': value} if direction > 0 else {'$not': {'$gte': value}}
+
+
+def get_path(entry, field):
+    value = entry
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
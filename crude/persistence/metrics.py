@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+
+from pymongo import monitoring
+
+SLOW_COMMAND_MS = float(os.getenv('SLOW_COMMAND_MS', '100'))
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+TRACED_COMMAND_LENGTH = 500
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self, common_labels=None):
+        # common_labels are added to every sample, e.g. the worker
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = (common_labels or {}) | dict(key)
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(sample(self.name + '_bucket', labels | {'le': str(bound)}, count))
+                lines.append(sample(self.name + '_bucket', labels | {'le': '+Inf'}, series['count']))
+                lines.append(sample(self.name + '_sum', labels, series['sum']))
+                lines.append(sample(self.name + '_count', labels, series['count']))
+        return lines
+
+
+def sample(name, labels, value):
+    if len(labels) == 0:
+        return '%s %s' % (name, value)
+    label_text = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels.items())
+    return '%s{%s} %s' % (name, label_text, value)
+
+
+def gauge(name, help_text, values, metric_type='gauge', common_labels=None):
+    # values: [(labels, value)]
+    return ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)] + [sample(name, (common_labels or {}) | labels, value) for labels, value in values]
+
+
+class CommandStats(monitoring.CommandListener):
+    # times every command and, while a request trace is active on the current thread, adds it to that trace
+    def __init__(self):
+        self.local = threading.local()
+        self.started_commands = {}
+        self.durations = Histogram('mongo_command_duration_seconds', 'Duration of MongoDB commands', LATENCY_BUCKETS)
+
+    def start_trace(self):
+        self.local.trace = []
+
+    def stop_trace(self):
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        return trace or []
+
+    def started(self, event):
+        self.started_commands[event.request_id] = (command_collection(event.command_name, event.command), event.command)
+
+    def succeeded(self, event):
+        self.record(event, 'ok')
+
+    def failed(self, event):
+        self.record(event, 'failed')
+
+    def record(self, event, outcome):
+        collection, command = self.started_commands.pop(event.request_id, ('', None))
+        seconds = event.duration_micros / 1000000
+        self.durations.observe({'command': event.command_name, 'collection': collection, 'outcome': outcome}, seconds)
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace.append((event.command_name, collection, seconds))
+        if seconds * 1000 >= SLOW_COMMAND_MS:
+            print('Slow MongoDB command (%.1f ms): %s %s %s' % (seconds * 1000, event.command_name, collection, shorten(command)))
+
+
+def command_collection(command_name, command):
+    collection = command.get('collection') if command_name == 'getMore' else command.get(command_name)
+    return collection if isinstance(collection, str) else ''
+
+
+def shorten(command):
+    if command is None:
+        return ''
+    try:
+        text = json.dumps(command, default=str)
+    except (TypeError, ValueError):
+        text = str(command)
+    return text[:TRACED_COMMAND_LENGTH] + ('...' if len(text) > TRACED_COMMAND_LENGTH else '')
+
+
+command_stats = CommandStats()
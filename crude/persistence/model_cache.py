@@ -0,0 +1,57 @@
+import copy
+import threading
+
+MODELS_GENERATION_KEY = 'models'
+
+
+class ModelCache:
+    def __init__(self, generations):
+        self.generations = generations
+        self.generation = None
+        self.models = {}
+        self.derived = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, models_collection, meta_collection):
+        generation = self.generations.current(meta_collection, MODELS_GENERATION_KEY)
+        if generation == self.generation:
+            return
+        with self.lock:
+            if generation == self.generation:
+                return
+            self.models = {model['name']: model for model in models_collection.find()}
+            self.derived = {}
+            self.generation = generation
+
+    def get(self, model_name):
+        # callers mutate the models they get (field functions, resolved relations), so hand out copies
+        model = self.models.get(model_name)
+        return copy.deepcopy(model) if model else None
+
+    def peek(self, model_name):
+        # the shared instance, strictly read-only
+        return self.models.get(model_name)
+
+    def derive(self, model_name, key, build):
+        # a value computed from a model (and key, e.g. a version of its inputs) once per model version;
+        # build gets the shared model instance and must not mutate it
+        model = self.models.get(model_name)
+        if model is None:
+            return None
+        cached = self.derived.get((model_name, key))
+        if cached is not None and cached[0] is model:
+            return cached[1]
+        value = build(model)
+        self.derived[(model_name, key)] = (model, value)
+        return value
+
+    def find_references(self, model_name):
+        # (model name, field definition) of every related field pointing at model_name, strictly read-only
+        return [(model['name'], field) for model in self.models.values() for field in model['fields'] if field['type'] == 'related' and field.get('related_model') == model_name]
+
+    def get_all(self, model_names=None):
+        models = self.models
+        return [copy.deepcopy(model) for name, model in models.items() if model_names is None or name in model_names]
+
+    def get_names(self):
+        return list(self.models.keys())
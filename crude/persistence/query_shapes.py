@@ -0,0 +1,199 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from persistence.jobs import JobQueue
+
+QUERY_SHAPES_COLLECTION = '_query_shapes'
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte'}
+EQUALITY_OPERATORS = {'$eq', '$in', '$all'}
+NEGATION_OPERATORS = {'$ne', '$nin', '$not'}
+
+# a query shape is what is left of a query without its values:
+# {'filter': [[field, operator class], ...], 'sort': [[field, direction], ...]}
+# operator classes: eq, range, regex, exists, ne, elem, or (field only used inside $or/$nor), other
+
+
+def query_shape(filter_expression, sort_list=None):
+    fields = {}
+    collect_fields(filter_expression or {}, fields, False)
+    return {
+        'filter': sorted([field, '+'.join(sorted(classes))] for field, classes in fields.items()),
+        'sort': [[field, direction] for field, direction in (sort_list or [])]
+    }
+
+
+def collect_fields(expression, fields, in_or):
+    for key, value in expression.items():
+        if key == '$and':
+            for sub_expression in value:
+                collect_fields(sub_expression, fields, in_or)
+        elif key in ['$or', '$nor']:
+            for sub_expression in value:
+                collect_fields(sub_expression, fields, True)
+        elif key.startswith('$'):
+            fields.setdefault(key, set()).add('other')
+        else:
+            fields.setdefault(key, set()).add('or' if in_or else operator_class(value))
+
+
+def operator_class(value):
+    if hasattr(value, 'pattern'):
+        return 'regex'
+    if not isinstance(value, dict) or not any(key.startswith('$') for key in value):
+        return 'eq'
+    operators = set(value.keys()) - {'$options'}
+    if operators <= EQUALITY_OPERATORS:
+        return 'eq'
+    if operators <= RANGE_OPERATORS:
+        return 'range'
+    if '$regex' in operators:
+        return 'regex'
+    if operators == {'$exists'}:
+        return 'exists'
+    if operators <= NEGATION_OPERATORS:
+        return 'ne'
+    if '$elemMatch' in operators:
+        return 'elem'
+    return 'other'
+
+
+def shape_id(model_name, shape):
+    return model_name + ' ' + json.dumps(shape, sort_keys=True)
+
+
+def explain_summary(explain):
+    planner = explain.get('queryPlanner', {})
+    winning_plan = planner.get('winningPlan', {})
+    stages = plan_stages(winning_plan.get('queryPlan', winning_plan))
+    stats = explain.get('executionStats', {})
+    return {
+        'stages': stages,
+        'collscan': 'COLLSCAN' in stages,
+        'in_memory_sort': 'SORT' in stages,
+        'docs_examined': stats.get('totalDocsExamined', 0),
+        'keys_examined': stats.get('totalKeysExamined', 0),
+        'returned': stats.get('nReturned', 0),
+    }
+
+
+def plan_stages(plan):
+    stages = [plan['stage']] if 'stage' in plan else []
+    if 'inputStage' in plan:
+        stages += plan_stages(plan['inputStage'])
+    for input_stage in plan.get('inputStages', []):
+        stages += plan_stages(input_stage)
+    return stages
+
+
+class QueryShapes:
+    # counts query shapes per model in memory and adds them up in the _query_shapes collection every flush_interval
+    # seconds; the first query of every shape (per worker) is explained in the background with the query planner only,
+    # a sample of the rest with execution stats (they run the query once more)
+    def __init__(self, sample_rate=0.01, flush_interval=10.0, max_shapes=10000):
+        self.sample_rate = sample_rate
+        self.max_shapes = max_shapes
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.explained = set()
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.jobs = JobQueue('query-shapes')
+
+    def record(self, db, model_name, filter_expression, sort_list=None, limit=0):
+        shape = query_shape(filter_expression, sort_list)
+        key = shape_id(model_name, shape)
+        with self.lock:
+            entry = self.pending.setdefault(key, {'model': model_name, 'shape': shape, 'count': 0})
+            entry['count'] += 1
+            verbosity = 'queryPlanner' if key not in self.explained else 'executionStats' if random.random() < self.sample_rate else None
+            if len(self.explained) >= self.max_shapes:
+                self.explained.clear()
+            self.explained.add(key)
+            flush = time.monotonic() - self.flushed_at >= self.flush_interval
+            if flush:
+                pending = self.pending
+                self.pending = {}
+                self.flushed_at = time.monotonic()
+        if verbosity and '$text' not in filter_expression:
+            self.jobs.submit(('explain', key), explain_query, db, key, filter_expression, sort_list, limit, verbosity)
+        if flush:
+            self.jobs.submit(None, save_counts, db, pending)
+
+    def flush(self, db):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.flushed_at = time.monotonic()
+        save_counts(db, pending)
+
+
+def save_counts(db, pending):
+    now = datetime.utcnow()
+    requests = [UpdateOne({'_id': key}, {'$inc': {'count': entry['count']}, '$set': {'model': entry['model'], 'shape': entry['shape'], 'last_seen': now}}, upsert=True) for key, entry in pending.items()]
+    if len(requests) > 0:
+        db[QUERY_SHAPES_COLLECTION].bulk_write(requests, ordered=False)
+
+
+def explain_query(db, key, filter_expression, sort_list, limit, verbosity='queryPlanner'):
+    # cursor.explain() would use allPlansExecution and run every candidate plan
+    model_name = key.split(' ', 1)[0]
+    find = {'find': model_name, 'filter': filter_expression, 'projection': {'_id': 1}}
+    if sort_list:
+        find['sort'] = dict((field, direction) for field, direction in sort_list)
+    if limit:
+        find['limit'] = limit
+    summary = explain_summary(db.command('explain', find, verbosity=verbosity))
+    update = {
+        '$inc': {'explain.samples': 1, 'explain.collscans': 1 if summary['collscan'] else 0, 'explain.in_memory_sorts': 1 if summary['in_memory_sort'] else 0},
+        '$set': {'explain.last': summary}
+    }
+    if verbosity != 'queryPlanner':
+        # only execution stats know how many documents were examined
+        update['$max'] = {'explain.max_examined_ratio': summary['docs_examined'] / max(summary['returned'], 1)}
+    db[QUERY_SHAPES_COLLECTION].update_one({'_id': key}, update, upsert=True)
+
+
+def suggest_index(shape, declared_indexes):
+    # equality fields first, then the sort, then range fields; None if nothing to index or already declared
+    filter_fields = dict((field, operator) for field, operator in shape['filter'])
+    if any(field.startswith('$') or 'or' in operator.split('+') or 'other' in operator.split('+') for field, operator in filter_fields.items()):
+        return None
+    keys = {}
+    for field, operator in filter_fields.items():
+        if operator == 'eq':
+            keys[field] = 1
+    for field, direction in shape['sort']:
+        if field == '_id' and len(keys) == 0 and len(shape['sort']) == 1:
+            return None
+        keys.setdefault(field, direction)
+    for field, operator in filter_fields.items():
+        if operator in ['range', 'regex', 'exists']:
+            keys.setdefault(field, 1)
+    if len(keys) == 0 or list(keys.keys()) == ['_id']:
+        return None
+    for index in declared_indexes:
+        declared_keys = list(index['keys'].items())
+        if declared_keys[:len(keys)] == list(keys.items()):
+            return None
+    return {'keys': keys}
+
+
+def index_advice(model, shape_docs, min_count=10, max_examined_ratio=10):
+    # shape_docs: documents of the _query_shapes collection for this model, suggestions only where explain found a
+    # collection scan, an in-memory sort or many documents examined per returned document
+    declared_indexes = model.get('indexes', [])
+    advice = []
+    suggested_indexes = []
+    for shape_doc in shape_docs:
+        explain = shape_doc.get('explain', {})
+        slow = explain.get('collscans', 0) > 0 or explain.get('in_memory_sorts', 0) > 0 or explain.get('max_examined_ratio', 0) > max_examined_ratio
+        suggestion = suggest_index(shape_doc['shape'], declared_indexes + suggested_indexes) if slow and shape_doc.get('count', 0) >= min_count else None
+        if suggestion:
+            suggested_indexes.append(suggestion)
+        advice.append({'shape': shape_doc['shape'], 'count': shape_doc.get('count', 0), 'explain': explain, 'suggestion': suggestion})
+    return advice, suggested_indexes
@@ -0,0 +1,58 @@
+SEARCH_TOKENS_FIELD = '_search_tokens'
+NGRAM_SIZE = 3
+PREFIX_LENGTH = 16
+MAX_INDEXED_LENGTH = 1024
+TRUNCATED_TOKEN = 'x:truncated'
+REGEX_SPECIAL_CHARACTERS = set('.^$*+?{}[]\\|()')
+
+# tokens are "p:<prefix>" for every prefix (up to PREFIX_LENGTH) of a field value (of every item of a list)
+# and "g:<trigram>" for every trigram of a field value, all lowercased; trigrams are only taken from the first
+# MAX_INDEXED_LENGTH characters, entries with longer values get TRUNCATED_TOKEN and are always checked by the regex
+
+
+def search_tokens(search_fields, entry):
+    tokens = set()
+    for field_name in search_fields:
+        value = entry.get(field_name)
+        for item in value if isinstance(value, list) else [value]:
+            if item is None:
+                continue
+            text = str(item).lower()
+            if len(text) > MAX_INDEXED_LENGTH:
+                tokens.add(TRUNCATED_TOKEN)
+                text = text[:MAX_INDEXED_LENGTH]
+            tokens.update('p:' + text[:length] for length in range(1, min(len(text), PREFIX_LENGTH) + 1))
+            tokens.update('g:' + ngram for ngram in ngrams(text))
+    return sorted(tokens)
+
+
+def ngrams(text):
+    return [text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)]
+
+
+def prefix_query(search_fields, search_term):
+    if any(character in REGEX_SPECIAL_CHARACTERS for character in search_term):
+        return None
+    term = search_term.lower()
+    if len(term) <= PREFIX_LENGTH:
+        return {SEARCH_TOKENS_FIELD: 'p:' + term}
+    return {'$and': [{SEARCH_TOKENS_FIELD: 'p:' + term[:PREFIX_LENGTH]}, prefix_regex_query(search_fields, search_term)]}
+
+
+def substring_query(search_fields, search_term):
+    # None means the term can not be answered from the index (too short or a real regular expression)
+    if len(search_term) < NGRAM_SIZE or any(character in REGEX_SPECIAL_CHARACTERS for character in search_term):
+        return None
+    tokens = sorted(set('g:' + ngram for ngram in ngrams(search_term.lower())))
+    candidates = {'$or': [{SEARCH_TOKENS_FIELD: {'$all': tokens}}, {SEARCH_TOKENS_FIELD: TRUNCATED_TOKEN}]}
+    return {'$and': [candidates, regex_query(search_fields, search_term)]}
+
+
+def prefix_regex_query(search_fields, search_term):
+    if len(search_fields) > 1:
+        return {'$or': [{field: {'$regex': '^' + search_term, '$options': 'i'}} for field in search_fields]}
+    return {search_fields[0]: {'$regex': '^' + search_term, '$options': 'i'}}
+
+
+def regex_query(search_fields, search_term):
+    return {'$or': [{field: {'$regex': search_term, '$options': 'i'}} for field in search_fields]}
@@ -1,150 +1,491 @@
-from pymongo import MongoClient
+from datetime import datetime, timedelta
+
+import pymongo
 from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from persistence.keyset import keyset_sort, keyset_filter
+from persistence.model_cache import MODELS_GENERATION_KEY
+from persistence.query_shapes import QUERY_SHAPES_COLLECTION
+from persistence.search_index import SEARCH_TOKENS_FIELD, search_tokens, prefix_query, substring_query, prefix_regex_query, regex_query
+
+HIDDEN_FIELDS = {SEARCH_TOKENS_FIELD: 0}
+COLLECTION_GENERATION_PREFIX = 'collection/'
+SAVE_ATTEMPTS = 3
+JOBS_COLLECTION = '_jobs'
+FIELD_TYPES_GENERATION_KEY = 'field-types'
+INDEX_NOT_FOUND = 27
+
+
+class RevisionConflict(Exception):
+    pass
+
+
+def collection_generation_key(model_name):
+    return COLLECTION_GENERATION_PREFIX + model_name
+
+
+def new_revision(data, rev=None):
+    # every entry carries a revision counter (_rev) and the time of its last write (_modified)
+    return data | {'_rev': (rev or 0) + 1, '_modified': datetime.utcnow()}
+
+
+REVISION_UPDATE = {'$inc': {'_rev': 1}, '$currentDate': {'_modified': True}}
+
+
+def replacement_pipeline(data):
+    # replaces the entry (or inserts it) and continues its revision in the same write, whatever it is by then
+    replacement = {key: value for key, value in data.items() if key not in ['_id', '_rev']} | {'_modified': datetime.utcnow()}
+    return [{'$replaceWith': {'$mergeObjects': [{'$literal': replacement}, {'_id': '$_id', '_rev': {'$add': [{'$ifNull': ['$_rev', 0]}, 1]}}]}}]
 
 
 class Storage:
-    def __init__(self, connection_string):
-        print('Connecting to MongoDB...:', connection_string)
-        self.client = MongoClient(connection_string)
+    def __init__(self, client, generations, model_cache, query_shapes=None):
+        self.client = client
         self.db = self.client.crude
         self.models = self.db['_models']
+        self.meta = self.db['_meta']
+        self.jobs = self.db[JOBS_COLLECTION]
+        self.generations = generations
+        self.model_cache = model_cache
+        self.query_shapes = query_shapes
+
+    def record_query(self, model_name, filter_expression, sort_list=None, limit=0):
+        if self.query_shapes is not None:
+            self.query_shapes.record(self.db, model_name, filter_expression, sort_list, limit)
+
+    def read_query_shapes(self, model_name):
+        if self.query_shapes is not None:
+            self.query_shapes.flush(self.db)
+        return list(self.db[QUERY_SHAPES_COLLECTION].find({'model': model_name}).sort('count', -1))
+
+    def list_index_keys(self, model_name):
+        collection = self.db[model_name]
+        return [{'keys': dict(index['key'])} for index in collection.list_indexes()]
+
+    def cached_models(self):
+        self.model_cache.refresh(self.models, self.meta)
+        return self.model_cache
+
+    def search_index_fields(self, model_name):
+        model = self.cached_models().peek(model_name)
+        if model and model.get('search_index'):
+            return get_search_fields(model)
+        return None
+
+    def with_search_tokens(self, model_name, data):
+        search_fields = self.search_index_fields(model_name)
+        if search_fields is None:
+            return data
+        return data | {SEARCH_TOKENS_FIELD: search_tokens(search_fields, data)}
+
+    def collection_generation(self, model_name):
+        return self.generations.current(self.meta, collection_generation_key(model_name))
+
+    def models_generation(self):
+        return self.generations.current(self.meta, MODELS_GENERATION_KEY)
+
+    def collection_changed(self, model_name):
+        return self.generations.bump(self.meta, collection_generation_key(model_name))
+
+    def field_types_generation(self):
+        return self.generations.current(self.meta, FIELD_TYPES_GENERATION_KEY)
+
+    def field_types_changed(self):
+        return self.generations.bump(self.meta, FIELD_TYPES_GENERATION_KEY)
 
     def create(self, model_name, data):
         collection = self.db[model_name]
-        entry_id = collection.insert_one(data).inserted_id
+        entry_id = collection.insert_one(self.with_search_tokens(model_name, new_revision(data))).inserted_id
+        self.collection_changed(model_name)
         return str(entry_id)
 
+    def insert_many(self, model_name, documents, ordered=False):
+        collection = self.db[model_name]
+        documents = [self.with_search_tokens(model_name, new_revision(document)) for document in documents]
+        try:
+            result = collection.insert_many(documents, ordered=ordered)
+            report = {'inserted': len(result.inserted_ids), 'errors': []}
+        except BulkWriteError as e:
+            errors = [{'index': error['index'], 'error': error['errmsg']} for error in e.details['writeErrors']]
+            report = {'inserted': e.details['nInserted'], 'errors': errors}
+        if report['inserted'] > 0:
+            self.collection_changed(model_name)
+        return report
+
+    def bulk_write(self, model_name, operations, ordered=True):
+        # operations: [{'op': 'insert'|'update'|'replace'|'delete', '_id': ObjectId, 'data': dict}]
+        collection = self.db[model_name]
+        requests = []
+        for operation in operations:
+            if operation['op'] == 'insert':
+                requests.append(InsertOne(self.with_search_tokens(model_name, new_revision(operation['data'] | {'_id': operation['_id']}))))
+            elif operation['op'] == 'update':
+                requests.append(UpdateOne({'_id': operation['_id']}, {'$set': operation['data']} | REVISION_UPDATE))
+            elif operation['op'] == 'replace':
+                requests.append(UpdateOne({'_id': operation['_id']}, replacement_pipeline(self.with_search_tokens(model_name, operation['data'])), upsert=True))
+            elif operation['op'] == 'delete':
+                requests.append(DeleteOne({'_id': operation['_id']}))
+        if len(requests) == 0:
+            return {'counts': {}, 'errors': {}}
+        try:
+            result = collection.bulk_write(requests, ordered=ordered)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+        errors = {error['index']: error['errmsg'] for error in details['writeErrors']}
+        counts = {key: details[key] for key in ['nInserted', 'nMatched', 'nModified', 'nUpserted', 'nRemoved']}
+        updated_ids = [operation['_id'] for index, operation in enumerate(operations) if operation['op'] == 'update' and index not in errors]
+        self.refresh_search_tokens(model_name, updated_ids)
+        if len(errors) < len(requests):
+            self.collection_changed(model_name)
+        return {'counts': counts, 'errors': errors}
+
+    def read_batch(self, model_name, last_id, projection_fields, batch_size):
+        # the next batch of entries in _id order, for jobs that walk a whole collection
+        collection = self.db[model_name]
+        query_expression = {'_id': {'$gt': last_id}} if last_id else {}
+        projection = {field_name: 1 for field_name in projection_fields} | {'_rev': 1}
+        return list(collection.find(query_expression, projection).sort('_id', 1).limit(batch_size))
+
+    def update_entries(self, model_name, changes):
+        # changes: [(entry, {field: value})]; an entry is skipped if one of these fields has been written since it
+        # was read, writes of other fields do not matter
+        collection = self.db[model_name]
+        requests = [UpdateOne({'_id': entry['_id']} | {field_name: entry[field_name] for field_name in data}, {'$set': data} | REVISION_UPDATE) for entry, data in changes]
+        if len(requests) == 0:
+            return 0
+        result = collection.bulk_write(requests, ordered=False)
+        if result.modified_count > 0:
+            self.refresh_search_tokens(model_name, [entry['_id'] for entry, data in changes])
+            self.collection_changed(model_name)
+        return result.modified_count
+
+    def count_missing(self, model_name, field_names):
+        # entries per field that have no value for it, as {field: count}
+        collection = self.db[model_name]
+        return {field_name: collection.count_documents({field_name: None}) for field_name in field_names}
+
+    def refresh_search_tokens(self, model_name, entry_ids):
+        search_fields = self.search_index_fields(model_name)
+        if search_fields is None or len(entry_ids) == 0:
+            return 0
+        collection = self.db[model_name]
+        projection = {field_name: 1 for field_name in search_fields}
+        entries = collection.find({'_id': {'$in': entry_ids}}, projection)
+        requests = [UpdateOne({'_id': entry['_id']}, {'$set': {SEARCH_TOKENS_FIELD: search_tokens(search_fields, entry)}}) for entry in entries]
+        if len(requests) > 0:
+            collection.bulk_write(requests, ordered=False)
+        return len(requests)
+
     def read(self, model_name, entry_id):
         collection = self.db[model_name]
-        entry = collection.find_one({'_id': ObjectId(entry_id)})
+        entry = collection.find_one({'_id': ObjectId(entry_id)}, HIDDEN_FIELDS)
         return entry
 
-    def update(self, model_name, entry_id, data):
+    def read_revision(self, model_name, entry_id):
+        collection = self.db[model_name]
+        return collection.find_one({'_id': ObjectId(entry_id)}, {'_rev': 1, '_modified': 1})
+
+    def update(self, model_name, entry_id, data, expected_rev=None):
+        # expected_rev: fail with RevisionConflict unless the entry is still at this revision
         collection = self.db[model_name]
-        result = collection.update_one({'_id': ObjectId(entry_id)}, {'$set': data})
-        return {'affected': result.modified_count}
+        query_expression = revision_query(entry_id, expected_rev) if expected_rev is not None else {'_id': ObjectId(entry_id)}
+        search_fields = self.search_index_fields(model_name)
+        if search_fields is None or not any(field_name in data for field_name in search_fields):
+            result = collection.update_one(query_expression, {'$set': data} | REVISION_UPDATE)
+            if expected_rev is not None and result.matched_count == 0:
+                raise RevisionConflict('%s/%s has been changed in the meantime' % (model_name, entry_id))
+            if result.modified_count > 0:
+                self.collection_changed(model_name)
+            return {'affected': result.modified_count}
+        entry = collection.find_one_and_update(query_expression, {'$set': data} | REVISION_UPDATE, return_document=ReturnDocument.AFTER)
+        if entry is None:
+            if expected_rev is not None:
+                raise RevisionConflict('%s/%s has been changed in the meantime' % (model_name, entry_id))
+            return {'affected': 0}
+        collection.update_one({'_id': entry['_id']}, {'$set': {SEARCH_TOKENS_FIELD: search_tokens(search_fields, entry)}})
+        self.collection_changed(model_name)
+        return {'affected': 1}
 
-    def save(self, model_name, entry_id, data):
+    def save(self, model_name, entry_id, data, expected_rev=None):
+        # replaces the entry only if its revision did not change since it was read, retrying a few times
+        # when no revision is expected by the caller
         collection = self.db[model_name]
-        result = collection.replace_one({'_id': ObjectId(entry_id)}, data, upsert=True)
-        return result.raw_result
+        for attempt in range(SAVE_ATTEMPTS):
+            rev = expected_rev
+            if rev is None:
+                current = self.read_revision(model_name, entry_id)
+                rev = current.get('_rev', 0) if current else None
+            try:
+                result = collection.replace_one(revision_query(entry_id, rev), self.with_search_tokens(model_name, new_revision(data, rev)), upsert=expected_rev is None)
+            except DuplicateKeyError:
+                if expected_rev is None and self.read_revision(model_name, entry_id) is not None:
+                    continue
+                raise
+            if result.matched_count > 0 or result.upserted_id is not None:
+                self.collection_changed(model_name)
+                return result.raw_result
+            if expected_rev is not None:
+                break
+        raise RevisionConflict('%s/%s has been changed in the meantime' % (model_name, entry_id))
 
     def delete(self, model_name, entry_id):
         collection = self.db[model_name]
         result = collection.delete_one({'_id': ObjectId(entry_id)})
+        if result.deleted_count > 0:
+            self.collection_changed(model_name)
         return {'affected': result.deleted_count}
 
-    def find_relations(self, related_model_name, related_model_field, compound_id, limit=10):
+    def find_references(self, model_name):
+        return self.cached_models().find_references(model_name)
+
+    def refresh_labels(self, model_name, field_name, compound_id, label, batch_size=500):
+        # rewrites the cached label of compound_id in every entry of model_name where it differs
+        collection = self.db[model_name]
+        labels_path = '_labels.' + field_name
+        stale = {labels_path: {'$elemMatch': {'id': compound_id, '$or': [{'label': {'$ne': label['label']}}, {'fields': {'$ne': label['fields']}}]}}}
+        updated = 0
+        while True:
+            ids = [entry['_id'] for entry in collection.find(stale, {'_id': 1}).limit(batch_size)]
+            if len(ids) == 0:
+                return updated
+            # a new revision, so conditional requests do not keep serving the old label
+            result = collection.update_many({'_id': {'$in': ids}} | stale, {'$set': {labels_path + '.$[label]': label}} | REVISION_UPDATE, array_filters=[{'label.id': compound_id}])
+            if result.modified_count == 0:
+                return updated
+            if updated == 0:
+                self.collection_changed(model_name)
+            updated += result.modified_count
+
+    def pull_references(self, model_name, field_name, compound_id, reference, batch_size=500):
+        # removes the reference (stored form of compound_id) and its cached label from field_name of every entry of
+        # model_name, batch by batch
+        collection = self.db[model_name]
+        pull = {'$pull': {field_name: reference, '_labels.' + field_name: {'id': compound_id}}}
+        updated = 0
+        while True:
+            ids = [entry['_id'] for entry in collection.find({field_name: reference}, {'_id': 1}).limit(batch_size)]
+            if len(ids) == 0:
+                return updated
+            result = collection.update_many({'_id': {'$in': ids}}, pull | REVISION_UPDATE)
+            self.collection_changed(model_name)
+            updated += result.modified_count
+
+    def find_relations(self, related_model_name, related_model_field, reference, limit=10):
         collection = self.db[related_model_name]
-        query_expression = {related_model_field: compound_id}
-        cursor = collection.find(query_expression).limit(limit)
+        query_expression = {related_model_field: reference}
+        cursor = collection.find(query_expression, HIDDEN_FIELDS).limit(limit)
         return cursor
 
-    def find_all_ids(self, model_name, list_of_ids):
-        collection = self.db[model_name]
+    def find_relation_groups(self, related_model_name, references, limit=10, projection_fields=None, truncate=None):
+        # references: {related field: stored reference}
+        collection = self.db[related_model_name]
+        pipeline = relation_groups_pipeline(references, limit, projection_fields, truncate)
+        return relation_groups(references, next(collection.aggregate(pipeline)))
+
+    def find_all_ids(self, model_name, list_of_ids, projection_fields=None, truncate=None):
         ids = [ObjectId(string_id) for string_id in list_of_ids]
-        cursor = collection.find({'_id': {'$in': ids}})
-        return cursor
+        return self.query(model_name, {'_id': {'$in': ids}}, projection_fields=projection_fields, truncate=truncate)
 
-    def browse(self, model_name, filter_expression, sort_doc, page_number=1, items_per_page=10):
-        collection = self.db[model_name]
+    def browse(self, model_name, filter_expression, sort_doc, page_number=1, items_per_page=10, projection_fields=None, truncate=None):
         skips = items_per_page * (page_number - 1)
-        cursor = collection.find(filter_expression)
+        sort_list = [(field, direction) for field, direction in sort_doc.items()]
+        self.record_query(model_name, filter_expression, sort_list, skips + items_per_page)
+        return self.query(model_name, filter_expression, sort_list, skips, items_per_page, projection_fields, truncate)
+
+    def browse_keyset(self, model_name, filter_expression, sort_doc, keys=None, forward=True, items_per_page=10, projection_fields=None, truncate=None):
+        sort_list = keyset_sort(sort_doc)
+        self.record_query(model_name, filter_expression, sort_list, items_per_page + 1)
+        filter_expression, query_sort = keyset_query(filter_expression, sort_list, keys, forward)
+        entries = list(self.query(model_name, filter_expression, query_sort, 0, items_per_page + 1, projection_fields, truncate))
+        return keyset_page(entries, items_per_page, forward)
+
+    def export(self, model_name, filter_expression, sort_doc, batch_size=1000):
+        collection = self.db[model_name]
+        cursor = collection.find(filter_expression, HIDDEN_FIELDS).batch_size(batch_size)
         if len(sort_doc) > 0:
-            sort_list = [(field, direction) for field, direction in sort_doc.items()]
-            cursor.sort(sort_list)
-        cursor.skip(skips).limit(items_per_page)
+            cursor.sort([(field, direction) for field, direction in sort_doc.items()])
         return cursor
 
-    def get_count(self, model_name, query_expression):
+    def query(self, model_name, filter_expression, sort_list=None, skips=0, limit=0, projection_fields=None, truncate=None):
+        # plain find() unless long strings have to be cut down on the server, which needs an aggregation
+        collection = self.db[model_name]
+        if not truncate:
+            projection = {field_name: 1 for field_name in projection_fields} if projection_fields else HIDDEN_FIELDS
+            cursor = collection.find(filter_expression, projection)
+            if sort_list:
+                cursor.sort(sort_list)
+            return cursor.skip(skips).limit(limit)
+        pipeline = [{'$match': filter_expression}]
+        if sort_list:
+            pipeline.append({'$sort': dict(sort_list)})
+        if skips > 0:
+            pipeline.append({'$skip': skips})
+        if limit > 0:
+            pipeline.append({'$limit': limit})
+        pipeline.append(projection_stage(projection_fields, truncate))
+        return collection.aggregate(pipeline)
+
+    def get_count(self, model_name, query_expression, max_time_ms=None):
         collection = self.db[model_name]
+        if max_time_ms:
+            return collection.count_documents(query_expression, maxTimeMS=max_time_ms)
         return collection.count_documents(query_expression)
 
+    def get_estimated_count(self, model_name):
+        collection = self.db[model_name]
+        return collection.estimated_document_count()
+
+    def watch_changes(self, resume_token=None, max_await_time_ms=None):
+        # one change stream over the entries of all models; the internal collections (_models, _meta, _jobs, ...)
+        # are left out, updates carry the entry as it is after the change
+        pipeline = [
+            {'$match': {'ns.coll': {'$not': {'$regex': '^_'}}}},
+            {'$project': {'fullDocument.' + SEARCH_TOKENS_FIELD: 0}}
+        ]
+        return self.db.watch(pipeline, full_document='updateLookup', resume_after=resume_token, max_await_time_ms=max_await_time_ms)
+
+    def matches_filter(self, model_name, entry_id, filter_expression):
+        collection = self.db[model_name]
+        return collection.count_documents({'$and': [{'_id': entry_id}, filter_expression]}, limit=1) > 0
+
     def save_model(self, model_name, data):
         self.models.replace_one({'name': model_name}, data, upsert=True)
+        self.generations.bump(self.meta, MODELS_GENERATION_KEY)
 
     def read_model(self, model_name):
-        model = self.models.find_one({'name': model_name})
-        return model
+        return self.cached_models().get(model_name)
+
+    def peek_model(self, model_name):
+        # the cached model itself, strictly read-only
+        return self.cached_models().peek(model_name)
 
     def read_models(self, model_names):
-        model = self.models.find({'name': {'$in': model_names}})
-        return model
+        return self.cached_models().get_all(model_names)
 
     def delete_model(self, model_name):
         self.models.delete_one({'name': model_name})
+        self.generations.bump(self.meta, MODELS_GENERATION_KEY)
         return True
 
     def list_models(self):
-        models = self.models.find()
-        return models
+        return self.cached_models().get_all()
 
     def get_all_model_names(self):
-        models = self.models.find({}, {'name': 1})
-        return [model['name'] for model in models]
+        return self.cached_models().get_names()
 
     def get_search_and_display_fields(self, model_name):
-        model = self.models.find_one({'name': model_name})
-        search_fields = []
-        display_fields = []
-        if model and 'search_fields' in model:
-            search_fields = model['search_fields']
-        else:
-            search_fields = [field['name'] for field in model['fields'] if field['type'] == 'text']
-
-        if model and 'display_fields' in model:
-            display_fields = model['display_fields']
-        else:
-            display_fields = [field['name'] for field in model['fields'] if 'hidden' not in field]
-
-        return search_fields, display_fields
+        model = self.cached_models().peek(model_name)
+        return get_search_fields(model), get_display_fields(model)
 
     def full_text_search(self, model_name, search_fields, projection_fields, search_term, limit):
         collection = self.db[model_name]
         search_expression = {'$text': {'$search': search_term}}
         projection = {field: 1 for field in projection_fields}
         projection['score'] = {'$meta': 'textScore'}
+        self.record_query(model_name, search_expression)
         cursor = collection.find(search_expression, projection).sort([('score', {'$meta': 'textScore'})]).limit(limit)
         return cursor
 
     def prefix_search(self, model_name, search_fields, projection_fields, search_term, limit):
-        collection = self.db[model_name]
-        # use regex to match search_term as a prefix
-        if len(search_fields) > 1:
-            search_expression = {'$or': [{field: {'$regex': '^' + search_term, '$options': 'i'}} for field in search_fields]}
-        else:
-            search_expression = {search_fields[0]: {'$regex': '^' + search_term, '$options': 'i'}}
-        projection = {field: 1 for field in projection_fields}
-        cursor = collection.find(search_expression, projection).limit(limit)
-        return cursor
+        search_expression = prefix_search_expression(search_fields, search_term, self.search_index_fields(model_name) is not None)
+        return self.search_cursor(model_name, search_expression, projection_fields, limit)
 
     def regex_search(self, model_name, search_fields, projection_fields, search_term, limit):
+        search_expression = regex_search_expression(search_fields, search_term, self.search_index_fields(model_name) is not None)
+        return self.search_cursor(model_name, search_expression, projection_fields, limit)
+
+    def search_cursor(self, model_name, search_expression, projection_fields, limit):
         collection = self.db[model_name]
-        # use regex to match search_term anywhere in the field
-        search_expression = {'$or': [{field: {'$regex':  search_term, '$options': 'i'}} for field in search_fields]}
+        self.record_query(model_name, search_expression, limit=limit)
         projection = {field: 1 for field in projection_fields}
         cursor = collection.find(search_expression, projection).limit(limit)
         return cursor
 
-    def drop_indexes(self, model_name):
+    def rebuild_search_index(self, model_name, batch_size=1000):
         collection = self.db[model_name]
-        collection.drop_indexes()
-        return True
+        search_fields = self.search_index_fields(model_name)
+        if search_fields is None:
+            collection.update_many({SEARCH_TOKENS_FIELD: {'$exists': True}}, {'$unset': {SEARCH_TOKENS_FIELD: ''}})
+            return 0
+        self.create_search_index(model_name)
+        projection = {field_name: 1 for field_name in search_fields}
+        last_id = None
+        updated = 0
+        while True:
+            query_expression = {'_id': {'$gt': last_id}} if last_id else {}
+            entries = list(collection.find(query_expression, projection).sort('_id', 1).limit(batch_size))
+            if len(entries) == 0:
+                return updated
+            requests = [UpdateOne({'_id': entry['_id']}, {'$set': {SEARCH_TOKENS_FIELD: search_tokens(search_fields, entry)}}) for entry in entries]
+            collection.bulk_write(requests, ordered=False)
+            updated += len(entries)
+            last_id = entries[-1]['_id']
 
-    def set_wildcard_text_index(self, model_name):
+    def create_search_index(self, model_name):
         collection = self.db[model_name]
-        collection.create_index([('$**', 'text')])
+        collection.create_index([(SEARCH_TOKENS_FIELD, 1)])
         return True
 
-    def set_text_index(self, model_name, field_names):
+    def list_indexes(self, model_name):
         collection = self.db[model_name]
-        index_map = [(field_name, 'text') for field_name in field_names]
-        collection.create_index(index_map)
-        return True
+        return list(collection.list_indexes())
 
-    def create_index(self, model_name, keys, options):
+    def create_index(self, model_name, keys, options, timeout=None):
+        # index builds can take much longer than socketTimeoutMS
         collection = self.db[model_name]
-        collection.create_index(keys, **options)
+        with pymongo.timeout(timeout):
+            return collection.create_index([(field, direction) for field, direction in keys], **options)
+
+    def drop_index(self, model_name, index_name):
+        collection = self.db[model_name]
+        try:
+            collection.drop_index(index_name)
+        except OperationFailure as e:
+            # dropped by someone else in the meantime
+            if e.code != INDEX_NOT_FOUND:
+                raise
+        return True
+
+    def index_build_progress(self, model_name):
+        # progress of the index builds MongoDB is running on the collection, if the user may see currentOp
+        pipeline = [{'$currentOp': {'allUsers': True}}, {'$match': {'ns': self.db.name + '.' + model_name, 'command.createIndexes': {'$exists': True}}}]
+        try:
+            return [{'msg': op.get('msg'), 'progress': op.get('progress')} for op in self.client.admin.aggregate(pipeline)]
+        except OperationFailure:
+            return []
+
+    def create_job(self, job_type, model_name, data=None):
+        now = datetime.utcnow()
+        job = {'type': job_type, 'model': model_name, 'status': 'queued', 'created': now, 'updated': now} | (data or {})
+        return self.jobs.insert_one(job).inserted_id
+
+    def update_job(self, job_id, changes):
+        self.jobs.update_one({'_id': job_id}, {'$set': changes | {'updated': datetime.utcnow()}})
+
+    def read_jobs(self, job_type, model_name=None, limit=20):
+        query_expression = {'type': job_type} | ({'model': model_name} if model_name else {})
+        return list(self.jobs.find(query_expression).sort('created', -1).limit(limit))
+
+    def claim_job(self, job_id, worker, lease_seconds):
+        # a job runs in one worker at a time: whoever holds an unexpired lease; returns the job or None
+        now = datetime.utcnow()
+        query_expression = {'_id': job_id, 'status': {'$in': ['queued', 'running']}, '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]}
+        changes = {'status': 'running', 'worker': worker, 'lease_until': now + timedelta(seconds=lease_seconds), 'updated': now}
+        return self.jobs.find_one_and_update(query_expression, {'$set': changes}, return_document=ReturnDocument.AFTER)
+
+    def find_resumable_jobs(self, job_type):
+        # unfinished jobs nobody holds a lease for, e.g. because their worker was restarted
+        now = datetime.utcnow()
+        query_expression = {'type': job_type, 'status': {'$in': ['queued', 'running']}, '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]}
+        return list(self.jobs.find(query_expression, {'_id': 1, 'model': 1}).sort('created', 1))
+
+    def latest_jobs(self, job_type):
+        # the most recent job per model
+        pipeline = [{'$match': {'type': job_type}}, {'$sort': {'created': -1}}, {'$group': {'_id': '$model', 'job': {'$first': '$$ROOT'}}}]
+        return {result['_id']: result['job'] for result in self.jobs.aggregate(pipeline)}
 
     def get_collection(self, model_name):
         return self.db[model_name]
@@ -170,10 +511,91 @@ class Storage:
             'validationLevel': 'strict',
             'validationAction': 'error'
         }
+        if len(required_fields) == 0:
+            command = {'collMod': model_name, 'validator': {}, 'validationLevel': 'off'}
         print(command)
         result = self.db.command(command)
         print(result)
         return True
 
-    def close(self):
-        return self.client.close()
\ No newline at end of file
+
+def keyset_query(filter_expression, sort_list, keys=None, forward=True):
+    if keys is not None:
+        filter_expression = {'$and': [filter_expression, keyset_filter(sort_list, keys, forward)]}
+    query_sort = sort_list if forward else [(field, -direction) for field, direction in sort_list]
+    return filter_expression, query_sort
+
+
+def keyset_page(entries, items_per_page, forward=True):
+    # entries holds one more entry than the page if there are more
+    has_more = len(entries) > items_per_page
+    entries = entries[:items_per_page]
+    if not forward:
+        entries.reverse()
+    return entries, has_more
+
+
+def relation_groups_pipeline(references, limit=10, projection_fields=None, truncate=None):
+    project_stage = projection_stage(projection_fields, truncate) or {'$unset': SEARCH_TOKENS_FIELD}
+    facets = {}
+    for index, (related_model_field, reference) in enumerate(references.items()):
+        facets['entries_%d' % index] = [{'$match': {related_model_field: reference}}, {'$limit': limit}, project_stage]
+        facets['count_%d' % index] = [{'$match': {related_model_field: reference}}, {'$count': 'count'}]
+    return [
+        {'$match': {'$or': [{related_model_field: reference} for related_model_field, reference in references.items()]}},
+        {'$facet': facets}
+    ]
+
+
+def relation_groups(related_model_fields, result):
+    groups = {}
+    for index, related_model_field in enumerate(related_model_fields):
+        counts = result['count_%d' % index]
+        groups[related_model_field] = {'entries': result['entries_%d' % index], 'count': counts[0]['count'] if len(counts) > 0 else 0}
+    return groups
+
+
+def prefix_search_expression(search_fields, search_term, search_index=False):
+    search_expression = prefix_query(search_fields, search_term) if search_index else None
+    if search_expression is None:
+        # use regex to match search_term as a prefix
+        search_expression = prefix_regex_query(search_fields, search_term)
+    return search_expression
+
+
+def regex_search_expression(search_fields, search_term, search_index=False):
+    search_expression = substring_query(search_fields, search_term) if search_index else None
+    if search_expression is None:
+        # use regex to match search_term anywhere in the field
+        search_expression = regex_query(search_fields, search_term)
+    return search_expression
+
+
+def revision_query(entry_id, rev):
+    # entries written before revisions existed have no _rev, which matches None and 0 alike
+    if not rev:
+        return {'_id': ObjectId(entry_id), '_rev': {'$in': [None, 0]}}
+    return {'_id': ObjectId(entry_id), '_rev': rev}
+
+
+def get_search_fields(model):
+    if model and 'search_fields' in model:
+        return model['search_fields']
+    return [field['name'] for field in model['fields'] if field['type'] == 'text']
+
+
+def get_display_fields(model):
+    if model and 'display_fields' in model:
+        return model['display_fields']
+    return [field['name'] for field in model['fields'] if 'hidden' not in field]
+
+
+def projection_stage(projection_fields, truncate=None):
+    if not projection_fields:
+        return None
+    projection = {field_name: 1 for field_name in projection_fields}
+    for field_name, max_length in (truncate or {}).items():
+        if field_name in projection:
+            value = '$' + field_name
+            projection[field_name] = {'$cond': [{'$eq': [{'$type': value}, 'string']}, {'$substrCP': [value, 0, max_length]}, value]}
+    return {'$project': projection}
@@ -176,16 +176,35 @@ class Console extends HTMLElement {
         this.abortController.abort();
         this.abortController = new AbortController();
         this.lastSearchTerm = userInput;
-        self.modelNames.forEach(function(modelName) {
-            const url = '/entries/search/regex/' + modelName + '?q=' + userInput;
-            const options = {signal: self.abortController.signal, headers: new Headers({'X-CSRFToken': self.csrf_token})};
-            fetch(url, options).then(function(response) {
-                response.json().then(function(data) {
-                    self.addSearchResults(userInput, modelName, data);
+        // one request for all models, the server streams one JSON line per model as soon as its search is done
+        const url = '/entries/search/all?mode=regex&q=' + encodeURIComponent(userInput);
+        const options = {signal: self.abortController.signal, headers: new Headers({'X-CSRFToken': self.csrf_token})};
+        fetch(url, options).then(function(response) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            function readLines() {
+                return reader.read().then(function(chunk) {
+                    buffer += decoder.decode(chunk.value || new Uint8Array(), {stream: !chunk.done});
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+                    lines.forEach(function(line) {
+                        if (line.trim().length === 0) {
+                            return;
+                        }
+                        const data = JSON.parse(line);
+                        if (data.success) {
+                            self.addSearchResults(userInput, data.model, data);
+                        }
+                    });
+                    if (!chunk.done) {
+                        return readLines();
+                    }
                 });
-            }).catch(error => {
-                console.log(error);
-            });
+            }
+            return readLines();
+        }).catch(error => {
+            console.log(error);
         });
         this.autoCompleteTimeoutId = undefined;
     }